@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''Compare sequential and parallel CSV loading on a generated export.
+
+Writes a PACKINGSLIPS-shaped CSV of the requested size to a temporary
+directory, loads it with Table.from_csv and with Table.from_csv_parallel
+at several worker counts, checks the results are identical, and prints
+the timings.
+
+run as: "python benchmarks/parallel_load.py [rows] [max workers]"
+'''
+
+import csv
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from config import pslips_heading
+from tables import Table
+
+
+def write_export(path, rows):
+    header = ['Order', 'Rel', 'Packing Slip', 'Line', 'Part', 'Customer',
+              'Freighted Ship Via', 'Reference 1', 'Reference 3',
+              'Reference 4', 'Reference 2', 'Reference 5', 'Ship Date',
+              'Ship Via', 'Tracking Number', 'Address', 'Address2',
+              'Address3', 'Country', 'City', 'State/Province', 'Postal Code',
+              'Name', 'Customer', 'Rev Description', 'Qty']
+    rand = random.Random(0)
+    with open(path, 'wb') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(header)
+        for i in xrange(rows):
+            slip = 100000 + i // 4
+            customer = rand.randint(1, 40000)
+            writer.writerow([
+                90000 + i // 4, 1, slip, i % 4 + 1,
+                '%03d-%03d' % (rand.randint(0, 999), rand.randint(0, 999)),
+                customer, '', '', rand.randint(10 ** 9, 10 ** 10), '', '',
+                rand.randint(10000, 99999), '3/10/2015', 'UPSG',
+                '1Z%016d' % slip, '%d Some Street' % rand.randint(1, 9999),
+                '', '', 'USA', 'SEATTLE', 'WA', '%05d' % rand.randint(0, 99999),
+                'Customer "%d", Inc.' % customer, customer,
+                'PART DESCRIPTION %d' % rand.randint(1, 500),
+                rand.randint(1, 20)])
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    max_workers = (int(sys.argv[2]) if len(sys.argv) > 2
+                   else multiprocessing.cpu_count())
+    columns = pslips_heading.values()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, 'PACKINGSLIPS.csv')
+        write_export(path, rows)
+        print "%d rows, %.1f MB, %d CPU(s)" % (
+            rows, os.path.getsize(path) / 1e6, multiprocessing.cpu_count())
+
+        def sequential():
+            with open(path, 'rU') as csv_file:
+                return Table.from_csv(csv_file, keep_columns=columns)
+
+        base_time, expected = timed(sequential)
+        print "%-12s %8.2fs" % ('sequential', base_time)
+
+        workers = 1
+        while workers <= max_workers:
+            elapsed, table = timed(Table.from_csv_parallel, path,
+                                   keep_columns=columns, workers=workers)
+            assert table.header == expected.header
+            assert table.columns == expected.columns
+            print "%-12s %8.2fs  x%.2f" % ('%d worker(s)' % workers, elapsed,
+                                           base_time / elapsed)
+            workers *= 2
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+'''Measure UPS lookup throughput against the local stand-in server.
+
+Starts upsdata/standin.py on a background thread with the given latency,
+then looks up a batch of generated tracking numbers with
+prefetch_tracking_info at several concurrency levels and prints requests
+per second and lookup time percentiles for each.
+
+run as: "python benchmarks/ups_lookup.py [numbers] [latency] [error rate]"
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import upsdata
+from upsdata import standin
+from upsdata.validate import ups_check_digit
+
+
+def tracking_numbers(count, seed):
+    numbers = []
+    for i in xrange(count):
+        base = '1Z%06dA%08d' % (seed, i)
+        numbers.append(base + str(ups_check_digit(base + '0')))
+    return numbers
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+
+    settings = standin.StandinSettings(latency=latency, jitter=latency / 2,
+                                       error_rate=error_rate)
+    server = standin.start_in_thread(settings)
+    upsdata.options['tracking_url'] = server.url
+    print "%d lookups, %.2fs latency, %.0f%% errors, against %s" % (
+        count, latency, error_rate * 100, server.url)
+
+    try:
+        for run, concurrency in enumerate([1, 4, 8, 16, 32]):
+            upsdata.tracking_cache.clear()
+            upsdata.lookup_metrics.clear()
+            start = time.time()
+            results = upsdata.prefetch_tracking_info(
+                'user', 'password', 'license', tracking_numbers(count, run),
+                concurrency=concurrency)
+            elapsed = time.time() - start
+            failed = sum(isinstance(r, upsdata.TrackingServiceError)
+                         for r in results.values())
+            lookup = upsdata.lookup_metrics.summary()['seconds']['lookup']
+            print ("concurrency %3d: %7.2fs  %7.1f lookups/s  "
+                   "p50 %4.0fms  p99 %4.0fms  %d failed" % (
+                       concurrency, elapsed, count / elapsed,
+                       lookup['p50'] * 1000, lookup['p99'] * 1000, failed))
+    finally:
+        upsdata.close_clients()
+        server.shutdown()
+        server.server_close()
+        print "stand-in responses: %s" % ', '.join(
+            '%s=%d' % item for item in sorted(server.counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,34 @@ params = {
     'shipments_csv': 'CUSTOMERSHIPMENTS.csv',
     'packingslips_csv': 'PACKINGSLIPS.csv',
     'log_file': 'logfile.txt',
+
+    # Slips whose customer email was sent are recorded here and skipped on
+    # later runs (use --force to send again). Set to None to disable.
+    'ledger_file': 'sent_slips.sqlite',
+
+    # Slips UPS has no delivery date for (or whose lookup failed) wait here
+    # instead of being emailed "date unavailable". They're looked up again
+    # after recheck_interval seconds, then recheck_backoff times longer each
+    # time (at most recheck_interval_max), and sent once a date arrives, or
+    # with no date after recheck_max_attempts lookups or recheck_deadline
+    # seconds. Set recheck_file to None to send without a date straight away.
+    # (upsdata keeps a stored "unavailable" answer for store_ttl['unavailable']
+    # seconds, but a due recheck always asks UPS again.)
+    'recheck_file': 'recheck_slips.sqlite',
+    'recheck_interval': 2 * 3600,
+    'recheck_backoff': 2,
+    'recheck_interval_max': 24 * 3600,
+    'recheck_max_attempts': 6,
+    'recheck_deadline': 4 * 24 * 3600,
+
+    # Parsed copies of the CSV tables are kept here and reused until the
+    # CSV file changes. Set to None to always parse the CSVs.
+    'table_cache_dir': '.table_cache',
+
+    # CSV files at least this big are parsed in parallel by this many
+    # processes (None = one per CPU, 1 = never parse in parallel).
+    'csv_parse_workers': None,
+    'csv_parallel_min_bytes': 64 * 1024 * 1024,
     'BigVendor_code': 2758,
 
     'dlr_email_template_file': 'Dealer_email.html',
@@ -13,6 +41,23 @@ params = {
     'ups_userid': "xxxxxx",
     'ups_password': "xxxxxxx",
 
+    # Reject 1Z numbers whose check digit is wrong without asking UPS.
+    # (UPS's own test numbers don't all have valid check digits.)
+    'ups_verify_check_digit': True,
+
+    # Tracking numbers are looked up before the emails are built, this many
+    # at once, at most this many requests per second (None = no cap), for
+    # this many packing slips at a time (None = all slips together, or one
+    # at a time with --stream).
+    'ups_concurrency': 8,
+    'ups_requests_per_second': 10,
+    'ups_prefetch_window': 500,
+
+    # Timings, sizes and status codes of the run's UPS requests are logged
+    # as percentiles at the end of run_job, and saved here as JSON (None =
+    # don't save; --ups-metrics overrides).
+    'ups_metrics_file': None,
+
     # Used only for creating the link for an email recipient
     'ups_web_root': "http://wwwapps.ups.com/WebTracking/track?track=yes&trackNums=",
 
@@ -20,6 +65,34 @@ params = {
     'gmail_password': 'xxxxxxxxx',
     # gmail password is specified with "--password xxxx" command line option.
 
+    # Every email in a run goes through one logged-in SMTP session, which is
+    # reopened after this many messages (None = only when the server drops
+    # it). Seconds to wait for the server before giving up on a message.
+    'smtp_host': 'smtp.gmail.com',
+    'smtp_port': 587,
+    'smtp_messages_per_connection': 100,
+    'smtp_timeout': 60,
+
+    # Customer emails go out over this many sessions at once (1 = one at a
+    # time), at most this many per minute in all and per session (None = no
+    # cap). Gmail turns away accounts that send in bursts, so keep these
+    # well inside the account's daily sending limit spread over a run.
+    'smtp_connections': 4,
+    'smtp_messages_per_minute': 120,
+    'smtp_messages_per_minute_per_connection': 40,
+
+    # Customer emails are written to this spool directory as they're built
+    # and sent from there (see outbox.py), so a failed send is retried
+    # without looking anything up again: after outbox_retry_interval
+    # seconds, then outbox_retry_backoff times longer each time (at most
+    # outbox_retry_interval_max), until outbox_max_attempts sends have
+    # failed. Set outbox_dir to None to send straight away.
+    'outbox_dir': 'outbox',
+    'outbox_max_attempts': 8,
+    'outbox_retry_interval': 60,
+    'outbox_retry_backoff': 2,
+    'outbox_retry_interval_max': 3600,
+
     # This must be set to something that will never appear in a real email,
     # because we're doublechecking before sending them to make sure
     # this text isn't in the email to send.
@@ -37,10 +110,12 @@ params = {
     'email_address_for_company_records': "xxxx@xxxx.com",
     'email_address_for_contact_info_updating': "xxxx@xxxx.com",
 
-    # The 'simulated_emails' option causes the emailer to create HTML files in the
-    # working directory containing the email example, instead of actually sending
-    # anything to any email address. Overrides the "testing mode" below.
+    # The 'simulated_emails' option causes the emailer to save each run's emails
+    # in one mbox file in this directory, with a JSON-lines index of them (see
+    # simulation.py), instead of actually sending anything to any email
+    # address. Overrides the "testing mode" below.
     'simulated_emails': False,
+    'simulated_emails_dir': 'simulated_emails',
 
     # The 'email_in_testing_mode' option allows email addresses found in the
     # customer contacts sheet to be replaced by these testing addresses.
@@ -93,6 +168,26 @@ contacts_heading = {
     'email': 'EMail Address',
     }
 
+# Column types, by heading key: 'int', 'str' or 'date' (m/d/yyyy).
+# Unlisted columns are kept as text. Key columns that are matched across
+# tables (e.g. 'cust_id') must have the same type in each table.
+shipments_types = {
+    'cust_id': 'int',
+    'name': 'str',
+    'BigVendor_shortchar_lookup': 'str',
+    }
+
+pslips_types = {
+    'slip_id': 'int',
+    'cust_id': 'int',
+    'order_id': 'int',
+    'quantity': 'int',
+    }
+
+contacts_types = {
+    'cust_id': 'int',
+    }
+
 mail_fieldtags = {
     'greeting_name': 'putncdealernamehere',
     'dns': 'putdnshere',  # ["Big Vendor"] orders only
@@ -0,0 +1,77 @@
+'''One internal email per run about the slips that couldn't be sent.
+
+Each Notification that fails its checks used to send two internal emails
+(the problems with debugging info, and the incomplete customer email).
+main.run_job collects them in a ProblemDigest instead and sends a single
+email at the end: the slips grouped by what went wrong, with every slip's
+details in one HTML attachment. The details are written to a temporary
+file as slips are added, so only the slip IDs are kept in memory.
+'''
+
+import cgi
+import tempfile
+import time
+from collections import OrderedDict
+
+
+class ProblemDigest(object):
+
+    def __init__(self):
+        self.started_at = time.localtime()
+        self.started = time.strftime("%Y/%m/%d %H:%M", self.started_at)
+        self.count = 0
+        self.by_flag = OrderedDict()   # flag -> (description, [slip_id, ...])
+        self.details_file = tempfile.TemporaryFile(prefix='slip_problems_')
+
+    def __len__(self):
+        return self.count
+
+    def add(self, slip_id, problems, details, email_content):
+        '''Record a slip that wasn't sent. problems is a list of (flag,
+        description) pairs; details a dict of values worth showing.'''
+        parts = ["<hr><h3>Slip ID %s</h3><ul>" % slip_id]
+        parts.extend("<li>%s</li>" % cgi.escape(description)
+                     for flag, description in problems)
+        parts.append("</ul><p><b>Debugging info:</b></p><table>")
+        parts.extend("<tr><td>%s</td><td>%s</td></tr>"
+                     % (cgi.escape(str(key)), cgi.escape(str(value)))
+                     for key, value in sorted(details.items()))
+        parts.append("</table><p><b>Incomplete notification:</b></p>")
+        parts.append(email_content)
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            self.details_file.write(part + '\n')
+        self.count += 1
+        for flag, description in problems:
+            self.by_flag.setdefault(flag, (description, []))[1].append(slip_id)
+
+    def subject(self):
+        return ("Shipping notifications: %d slip(s) could not be sent (run of %s)"
+                % (self.count, self.started))
+
+    def summary_html(self):
+        parts = ["<p>%d packing slip(s) in the run started %s could not be sent "
+                 "a customer notification. Each slip's details and incomplete "
+                 "email are in the attached file.</p>"
+                 % (self.count, self.started)]
+        for flag, (description, slip_ids) in self.by_flag.items():
+            parts.append("<h3>%s (%d)</h3>" % (cgi.escape(description), len(slip_ids)))
+            parts.append("<p>%s</p>" % ', '.join(str(slip_id) for slip_id in slip_ids))
+        return '\n'.join(parts)
+
+    def details_html(self):
+        '''The attachment: every slip's details, read back from the file.'''
+        self.details_file.seek(0)
+        details = self.details_file.read()
+        self.details_file.seek(0, 2)
+        return "<html><body><h2>%s</h2>\n%s</body></html>" % (
+            cgi.escape(self.subject()), details)
+
+    def attachment_name(self):
+        return "slip_problems_%s.html" % time.strftime("%Y%m%d_%H%M",
+                                                        self.started_at)
+
+    def close(self):
+        '''Delete the details file.'''
+        self.details_file.close()
@@ -0,0 +1,44 @@
+'''Record of packing slips whose customer notification has been sent.
+
+main.run_job checks this before building a Notification, so slips handled
+on an earlier run are skipped without another UPS lookup or email. The
+record is a small sqlite file (params['ledger_file']).
+'''
+
+import sqlite3
+import time
+
+
+class SlipLedger(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sent_slips ('
+                          ' slip_id INTEGER PRIMARY KEY,'
+                          ' tracking_number TEXT,'
+                          ' sent_to TEXT,'
+                          ' sent_at TEXT)')
+        self.conn.commit()
+        # read once per run so membership checks don't touch the database
+        self.sent = set(row[0] for row in
+                        self.conn.execute('SELECT slip_id FROM sent_slips'))
+
+    def __contains__(self, slip_id):
+        return slip_id in self.sent
+
+    def __len__(self):
+        return len(self.sent)
+
+    def record(self, slip_id, tracking_number, sent_to):
+        '''Mark a slip as sent. Committed straight away, so a crash later
+        in the run doesn't cause the slip to be emailed again.'''
+        self.conn.execute('INSERT OR REPLACE INTO sent_slips '
+                          'VALUES (?, ?, ?, ?)',
+                          (slip_id, tracking_number, sent_to,
+                           time.strftime("%Y/%m/%d %H:%M:%S")))
+        self.conn.commit()
+        self.sent.add(slip_id)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,216 @@
+'''Outgoing mail through one logged-in SMTP session per account.
+
+main.send_gmail used to connect, STARTTLS and log in again for every
+message. An SMTPTransport does that once and sends message after message
+through the same session. It reconnects when the server drops the
+connection, and after `max_messages` messages, since Gmail closes
+sessions that send too many.
+
+A SenderPool sends from several such sessions at once. Messages wait in a
+queue and each result arrives in a PendingSend. The send rate is capped
+per session and for the pool as a whole.
+'''
+
+import Queue
+import smtplib
+import socket
+import threading
+
+from upsdata.ratelimit import RateLimiter
+
+# what send_result reports; main.send_gmail's results have always been these
+SENT_RESULT = "Done: no errors reported by mail server."
+ERROR_RESULT = "Error reported by email server: %s"
+
+
+class SMTPTransport(object):
+
+    def __init__(self, host, port, username, password, max_messages=None,
+                 timeout=None, log=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.log = log
+        self.server = None
+        self.sent_on_connection = 0
+        self.connections = 0
+        # one message at a time per session
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.timeout is None:
+            server = smtplib.SMTP(self.host, self.port)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            server.starttls()
+            server.ehlo()
+            login_result = server.login(self.username, self.password)
+        except:
+            server.close()
+            raise
+        if self.log is not None:
+            self.log("Email server login result:" + str(login_result))
+        self.server = server
+        self.sent_on_connection = 0
+        self.connections += 1
+
+    def disconnect(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            server.close()
+
+    def send(self, send_from, send_to, message):
+        '''Send a message (as text) with sendmail. Logs in first if there's
+        no open session. A session the server has dropped since its last
+        message is replaced, and the message sent again, once.'''
+        with self.lock:
+            if (self.max_messages and self.server is not None
+                    and self.sent_on_connection >= self.max_messages):
+                self.disconnect()
+            while True:
+                reused = self.server is not None
+                if not reused:
+                    self.connect()
+                try:
+                    result = self.server.sendmail(send_from, send_to, message)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    self.server.close()
+                    self.server = None
+                    if reused:
+                        continue
+                    raise
+                self.sent_on_connection += 1
+                return result
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+
+def send_result(transport, send_from, send_to, message):
+    '''Send a message through a transport and describe the outcome in
+    SENT_RESULT or ERROR_RESULT form.'''
+    try:
+        transport.send(send_from, send_to, message)
+        return SENT_RESULT
+    except (smtplib.SMTPException, socket.error) as e:
+        return ERROR_RESULT % str(e)
+
+
+class PendingSend(object):
+    '''The result string of a message that may not have been sent yet.'''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+    @classmethod
+    def completed(cls, value):
+        pending = cls()
+        pending.set(value)
+        return pending
+
+    def set(self, value):
+        self.value = value
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self):
+        # wait in short steps so Ctrl-C still works (Python 2 issue 8844)
+        while not self.event.wait(1):
+            pass
+        return self.value
+
+
+class SenderPool(object):
+    '''`connections` threads, each with its own SMTPTransport for one
+    account, sending the messages passed to submit().
+
+    per_minute caps the messages the whole pool sends in a minute, and
+    per_connection_per_minute what each session sends (None = no cap).
+    submit() blocks while `queue_size` messages are already waiting.'''
+
+    def __init__(self, host, port, username, password, connections=4,
+                 per_minute=None, per_connection_per_minute=None,
+                 max_messages=None, timeout=None, log=None, queue_size=None):
+        self.username = username
+        self.password = password
+        self.queue = Queue.Queue(maxsize=queue_size or 10 * connections)
+        self.limiter = RateLimiter(per_minute / 60.0 if per_minute else None)
+        self.workers = []
+        for i in range(connections):
+            transport = SMTPTransport(host, port, username, password,
+                                      max_messages=max_messages,
+                                      timeout=timeout, log=log)
+            limiter = RateLimiter(per_connection_per_minute / 60.0
+                                  if per_connection_per_minute else None)
+            worker = threading.Thread(target=self.work,
+                                      args=(transport, limiter))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, send_from, send_to, message):
+        pending = PendingSend()
+        self.queue.put((send_from, send_to, message, pending))
+        return pending
+
+    def work(self, transport, limiter):
+        try:
+            while True:
+                job = self.queue.get()
+                if job is None:
+                    return
+                send_from, send_to, message, pending = job
+                try:
+                    limiter.wait()
+                    self.limiter.wait()
+                    pending.set(send_result(transport, send_from, send_to,
+                                            message))
+                except Exception as e:
+                    # don't leave the message's PendingSend waiting forever
+                    pending.set(ERROR_RESULT % str(e))
+        finally:
+            transport.close()
+
+    def close(self):
+        '''Send what's still queued, then log out of every session.'''
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            while worker.is_alive():
+                worker.join(1)
+
+
+# One transport per account, shared by every send in a run
+transports = {}
+transports_lock = threading.Lock()
+
+
+def get_transport(host, port, username, password, **kwargs):
+    key = (host, port, username, password)
+    with transports_lock:
+        if key not in transports:
+            transports[key] = SMTPTransport(host, port, username, password,
+                                            **kwargs)
+        return transports[key]
+
+
+def close_transports():
+    '''Log out of every shared SMTPTransport session.'''
+    with transports_lock:
+        open_transports = transports.values()
+        transports.clear()
+    for transport in open_transports:
+        transport.close()
@@ -5,34 +5,36 @@ import argparse # command line arguments (--password)
 import time
 import logging
 
-import csv
 import re
+from collections import OrderedDict, deque
 from functools import partial
+from itertools import groupby, islice
 #from getpass import getpass
 
 import upsdata # separate code under upsdata directory
+import mailer
+from digest import ProblemDigest
+from ledger import SlipLedger
+from outbox import Outbox
+from recheck import RecheckQueue
+from simulation import SimulationSink
+from tables import (Table, CONVERTERS, convert_record, read_projected_rows,
+                    converters_key, file_fingerprint, load_snapshot,
+                    save_snapshot)
 # settings in config.py
 from config import (params, 
                     shipments_heading, pslips_heading, 
                     contacts_heading,  mail_fieldtags,
-                    item_column_labels)
+                    item_column_labels,
+                    shipments_types, pslips_types, contacts_types)
 
 # for email functionality
-import smtplib
 import os.path
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
 from email.Utils import formatdate
 
 
-dlr_email_template = open(params['dlr_email_template_file']).read()
-BigVendor_email_template = open(params['BigVendor_email_template_file']).read()
-
-contacts_dtable = list(csv.DictReader(open(params['contacts_csv'], 'rU')))
-shipments_dtable = list(csv.DictReader(open(params['shipments_csv'], 'rU')))
-pslips_dtable = list(csv.DictReader(open(params['packingslips_csv'], 'rU')))
-
-
 class Error(Exception):
     """Base class for exceptions in this module."""
     pass
@@ -51,6 +53,126 @@ class ContactInfoMissing(Error):
     def __init__(self, msg):
         self.msg = msg
 
+class SlipRowsNotContiguous(Error):
+    def __init__(self, slip_id):
+        self.slip_id = slip_id
+
+
+
+def report_missing_columns(csv_path, missing_columns):
+    for column in missing_columns:
+        log("%s: configured column %r is not in the CSV header"
+            % (csv_path, column))
+
+
+def column_converters(heading, types):
+    '''Map CSV column names to converters, from a config heading map and
+    its matching types map.'''
+    return dict((heading[key], CONVERTERS[type_name])
+                for key, type_name in types.items())
+
+
+def load_table(csv_path, heading, types, index_fields=()):
+    '''Load a CSV as a Table holding only the columns named in the
+    config heading map, with column types converted as declared in the
+    config types map and the given lookup columns indexed.
+
+    Files of at least params['csv_parallel_min_bytes'] are parsed by
+    params['csv_parse_workers'] processes (None for one per CPU, 1 to
+    always parse in this process).
+
+    If params['table_cache_dir'] is set, the finished table is also saved
+    there, and later runs reuse it until the CSV file, the heading or
+    types maps, or the converters change.'''
+    converters = column_converters(heading, types)
+    cache_dir = params.get('table_cache_dir')
+    if cache_dir:
+        build_key = (sorted(heading.values()), converters_key(converters),
+                     list(index_fields))
+        fingerprint = file_fingerprint(csv_path)
+        table = load_snapshot(cache_dir, csv_path, build_key, fingerprint)
+        if table is not None:
+            log("Loaded %s from table snapshot" % csv_path)
+            report_missing_columns(csv_path, table.missing_columns)
+            return table
+
+    workers = params.get('csv_parse_workers', 1)
+    if workers != 1 and (os.path.getsize(csv_path)
+                         >= params.get('csv_parallel_min_bytes', 0)):
+        table = Table.from_csv_parallel(csv_path,
+                                        keep_columns=heading.values(),
+                                        workers=workers)
+    else:
+        with open(csv_path, 'rU') as csv_file:
+            table = Table.from_csv(csv_file, keep_columns=heading.values())
+    report_missing_columns(csv_path, table.missing_columns)
+    rejected = table.convert_columns(converters)
+    for column, values in sorted(rejected.items()):
+        log("%s: %d value(s) in column %r kept as text, e.g. %r"
+            % (csv_path, len(values), column, values[0]))
+    table.build_indexes(index_fields)
+
+    if cache_dir:
+        try:
+            save_snapshot(cache_dir, csv_path, build_key, fingerprint, table)
+        except (IOError, OSError) as e:
+            log("Could not save table snapshot for %s: %s" % (csv_path, e))
+    return table
+
+
+class DataContext(object):
+    '''The CSV tables and email templates a run works from.
+
+    Nothing is read until it is first used, so importing this module does
+    no file I/O. Call load() to read everything up front, e.g. before
+    forking workers that should share one loaded copy.'''
+
+    def __init__(self, params):
+        self.params = params
+        self._loaded = {}
+
+    def _get(self, name, loader):
+        if name not in self._loaded:
+            self._loaded[name] = loader()
+        return self._loaded[name]
+
+    @property
+    def contacts(self):
+        return self._get('contacts', lambda: load_table(
+            self.params['contacts_csv'], contacts_heading, contacts_types,
+            index_fields=[contacts_heading['cust_id']]))
+
+    @property
+    def shipments(self):
+        return self._get('shipments', lambda: load_table(
+            self.params['shipments_csv'], shipments_heading, shipments_types,
+            index_fields=[shipments_heading['cust_id'],
+                          shipments_heading['BigVendor_shortchar_lookup']]))
+
+    @property
+    def pslips(self):
+        return self._get('pslips', lambda: load_table(
+            self.params['packingslips_csv'], pslips_heading, pslips_types))
+
+    @property
+    def dlr_email_template(self):
+        return self._get('dlr_email_template', lambda: open(
+            self.params['dlr_email_template_file']).read())
+
+    @property
+    def BigVendor_email_template(self):
+        return self._get('BigVendor_email_template', lambda: open(
+            self.params['BigVendor_email_template_file']).read())
+
+    def load(self, pslips=True):
+        self.contacts, self.shipments
+        self.dlr_email_template, self.BigVendor_email_template
+        if pslips:
+            self.pslips
+        return self
+
+
+data = DataContext(params)
 
 
 class PackedItem(object):
@@ -65,19 +187,60 @@ class PackedItem(object):
                                self.quantity)
 
 
+# Notification flags that stop a customer email, and what each one means
+flag_problems = [
+    ('flag_template_incomplete',
+     "One or more values needed to fill the email template was missing."),
+    ('flag_no_email_address',
+     "Customer email address could not be found in Contacts CSV."),
+    ('flag_no_greeting_name',
+     "For this non-JD order, customer name for email greeting could not be "
+     "pulled from the customer shipments CSV through a customer ID match."),
+    ('flag_bad_tracking_number',
+     "Tracking number is missing or reported invalid by UPS API."),
+    ]
+
+# a slip whose customer email is in the outbox's failed/ folder (run_job)
+outbox_failed_problem = (
+    'flag_outbox_failed',
+    "The customer email used up its send attempts and is in the outbox's "
+    "failed/ folder. Later runs skip the slip until \"python outbox.py "
+    "requeue\" puts it back.")
+
+# a slip in the recheck queue that the export no longer has (run_job)
+not_in_export_problem = (
+    'flag_not_in_export',
+    "Waited in the recheck queue for a delivery date, but the slip is no "
+    "longer in the packing slip export, so it was never sent.")
+
+
 class Notification(object):
-    def __init__(self, slip_id):
+    def __init__(self, slip_id, slip_rows=None, wait_for_date=False,
+                 last_chance=False, outbox=None, digest=None):
+        '''With wait_for_date=True, a slip UPS has no delivery date for is
+        deferred instead of sent with options['unavailable_msg']. With
+        last_chance=True it's sent regardless, and so is a slip whose UPS
+        lookup failed. Given an Outbox, the customer email is put in it
+        rather than sent. Given a ProblemDigest, a slip that can't be sent
+        is added to it instead of being reported in two internal emails.'''
         self.slip_id = int(slip_id)
 
         self.flag_template_incomplete = False 
         self.flag_no_email_address = False 
         self.flag_bad_tracking_number = False
         self.flag_no_greeting_name = False
+        self.sent = False
+        self.pending_send = None
+        self.spooled = False
+        self.deferred = False
+        self.deferred_reason = None
 
         missing_value_text = params['text_placeholder_if_info_missing']
 
-        slip_rows = [row for row in pslips_dtable 
-                     if row[pslips_heading['slip_id']] == slip_id]
+        # run_job passes rows already grouped by group_slip_rows
+        if slip_rows is None:
+            slip_rows = [row for row in data.pslips
+                         if row[pslips_heading['slip_id']] == self.slip_id]
 
         # should always return at least one row
         try:
@@ -90,14 +253,26 @@ class Notification(object):
 
         # Look up UPS information using upsdata (in subfolder)
         tracknum = slip_first[pslips_heading['tracknum']]
-        self.tracking_number = str(tracknum).upper().strip()
+        self.tracking_number = normalize_tracking_number(tracknum)
         try:
             self.expected_date = get_expected_date(self.tracking_number)
-        except upsdata.TrackingNumberInvalid:
-            log("Invalid tracking number: " + self.tracking_number)
-            self.bad_tracking_number = True
+            if (self.expected_date == upsdata.options['unavailable_msg']
+                    and wait_for_date and not last_chance):
+                self.deferred = True
+                self.deferred_reason = "no delivery date from UPS"
+        except upsdata.TrackingNumberInvalid as e:
+            log("Invalid tracking number: %s (%s)" % (self.tracking_number, e))
+            self.flag_bad_tracking_number = True
             self.flag_template_incomplete = True
             self.expected_date = missing_value_text
+        except upsdata.TrackingServiceError as e:
+            # UPS is down or timing out: don't hold the run up, and don't
+            # send this one without a date (unless it has waited long
+            # enough already); a later run will pick it up
+            log("UPS lookup failed for %s: %s" % (self.tracking_number, e))
+            self.deferred = not last_chance
+            self.deferred_reason = "UPS lookup failed: %s" % e
+            self.expected_date = upsdata.options['unavailable_msg']
 
         # record packed items, used to generate listing in email later
         self.items = [PackedItem(part_code=row[pslips_heading['partcode']],
@@ -120,7 +295,7 @@ class Notification(object):
             self.greeting_name = slip_first[pslips_heading['addr_name']]
             email_subject_line = params['email_subject_line_jd']
             try:
-               self.customer_id = dtable_query(dtable=shipments_dtable,
+               self.customer_id = dtable_query(dtable=data.shipments,
                                                index_field=shipments_heading['BigVendor_shortchar_lookup'],
                                                index_id=shortchar_val,
                                                output_field=shipments_heading['cust_id'])
@@ -135,7 +310,7 @@ class Notification(object):
             self.customer_id = slip_first[pslips_heading['cust_id']]
             email_subject_line = params['email_subject_line_non_jd']
             try:
-                self.greeting_name = dtable_query(dtable=shipments_dtable,
+                self.greeting_name = dtable_query(dtable=data.shipments,
                                                 index_field=shipments_heading['cust_id'],
                                                 index_id=self.customer_id,
                                                 output_field=shipments_heading['name'])
@@ -182,7 +357,10 @@ class Notification(object):
         problems = ["<p>Customer email could not be sent:</p><ul>"]
             
         # Decide whether email can be sent to customer
-        if all([not self.flag_template_incomplete, not self.flag_no_email_address,
+        if self.deferred:
+            log("Deferring slip [%s] until UPS lookups succeed" % self.slip_id)
+
+        elif all([not self.flag_template_incomplete, not self.flag_no_email_address,
                 not self.flag_bad_tracking_number, not self.flag_no_greeting_name]):
 
             # flags indicate that nothing is missing: verify output text, then proceed
@@ -204,62 +382,88 @@ class Notification(object):
             else:
                 actual_email_destination = self.contact_email
 
-            result = send_gmail(gmail_username=params['gmail_userid'], 
-                       gmail_pwd=params['gmail_password'],
-                       send_from=params['email_from_name'], 
-                       send_to=actual_email_destination, 
-                       cc_to=params['email_address_for_company_records'],
-                       subject=email_subject_line,
-                       html_content=self.email_content, 
-                       simulation_mode=params['simulated_emails'])
-            log(result)
+            if outbox is not None:
+                # drain_outbox sends it and records the slip in the ledger
+                message = build_email(send_from=params['email_from_name'],
+                                      send_to=actual_email_destination,
+                                      cc_to=params['email_address_for_company_records'],
+                                      subject=email_subject_line,
+                                      html_content=self.email_content)
+                name = outbox.put(params['email_from_name'],
+                                  actual_email_destination, message,
+                                  slip_id=self.slip_id,
+                                  tracking_number=self.tracking_number,
+                                  sent_to=self.contact_email,
+                                  testing=params['email_in_testing_mode'])
+                log("Email queued in the outbox as %s" % name)
+                self.spooled = True
+            else:
+                # with a sender pool running this only queues the email;
+                # run_job calls finish_send once it has gone
+                self.pending_send = queue_gmail(gmail_username=params['gmail_userid'], 
+                           gmail_pwd=params['gmail_password'],
+                           send_from=params['email_from_name'], 
+                           send_to=actual_email_destination, 
+                           cc_to=params['email_address_for_company_records'],
+                           subject=email_subject_line,
+                           html_content=self.email_content, 
+                           simulation_mode=params['simulated_emails'],
+                           slip_id=self.slip_id)
+                if self.pending_send.done():
+                    self.finish_send()
 
         else:
             # There is either a missing template value or a missing 
             # customer contact name/email
-            if self.flag_template_incomplete:
-                prob = "One or more values needed to fill the email template was missing."
-                problems.append("<li>" + prob + "</li>")
-                log(prob)
-            if self.flag_no_email_address:
-                prob = "Customer email address could not be found in Contacts CSV."
-                problems.append("<li>" + prob + "</li>")
-                log(prob)
             if self.flag_no_greeting_name:
                 assert not self.is_BigVendor # packing slip should always have a customer name
-                prob = ("For this non-JD order, customer name for email greeting could not be "
-                       "pulled from the customer shipments CSV through a customer ID match.")
-                problems.append("<li>" + prob + "</li>")
-                log(prob)
-            if self.flag_bad_tracking_number:
-                prob = "Tracking number is missing or reported invalid by UPS API."
+            flagged = [(flag, prob) for flag, prob in flag_problems
+                       if getattr(self, flag)]
+            for flag, prob in flagged:
                 problems.append("<li>" + prob + "</li>")
                 log(prob)
 
-            object_info = ['%s: %s' % (k, v) for k, v in vars(self).items()]
-            notification_details = '<br><br>'.join(sorted(object_info))
-            problems.append("</ul> <br><br> <b>Debugging info:</b> <br><br>\n" 
-                            + notification_details)
+            if digest is not None:
+                # run_job sends one email about all of the run's problems
+                details = dict((k, v) for k, v in vars(self).items()
+                               if k != 'email_content')
+                digest.add(self.slip_id, flagged, details, self.email_content)
 
-            email_note = '\n'.join(problems)
-            email_note_subject = ("Slip ID %s: could not send customer shipping "
-                                  "notification" % self.slip_id)
+            else:
+                object_info = ['%s: %s' % (k, v) for k, v in vars(self).items()]
+                notification_details = '<br><br>'.join(sorted(object_info))
+                problems.append("</ul> <br><br> <b>Debugging info:</b> <br><br>\n" 
+                                + notification_details)
+
+                email_note = '\n'.join(problems)
+                email_note_subject = ("Slip ID %s: could not send customer shipping "
+                                      "notification" % self.slip_id)
             
-            # Send detailed info in a notification email to internal address
-            send_internal_email(subject=email_note_subject, 
-                                content=email_note)
+                # Send detailed info in a notification email to internal address
+                send_internal_email(subject=email_note_subject, 
+                                    content=email_note)
 
-            # Send a clean copy of the shipping info (with missing info noted)
-            # to the internal notification address
-            send_internal_email(subject=("Incomplete notification for "
-                                         "slip ID %s" % self.slip_id),
-                                content=self.email_content)
+                # Send a clean copy of the shipping info (with missing info noted)
+                # to the internal notification address
+                send_internal_email(subject=("Incomplete notification for "
+                                             "slip ID %s" % self.slip_id),
+                                    content=self.email_content)
 
         #when sending email
 
         #    raise
 
 
+    def finish_send(self):
+        '''Wait for the customer email queued in __init__, if any, and
+        record whether it went out.'''
+        if self.pending_send is None:
+            return
+        result = self.pending_send.result()
+        self.pending_send = None
+        log(result)
+        self.sent = not result.startswith("Error")
+
     def get_html_item_table(self):
 
         # table can be rearranged by changing the order of both the
@@ -329,7 +533,7 @@ class Notification(object):
             raise
 
         if self.is_BigVendor:
-            template = BigVendor_email_template
+            template = data.BigVendor_email_template
             assert self.dns is not None
             replacing[mt['dns']] = self.dns  # add to list of replacement fields
             #For BigVendor orders, greet recipient with the "Name" field taken from packing slips 
@@ -339,7 +543,7 @@ class Notification(object):
         else:
             #For non-BigVendor orders, greet recipient with the name from contacts CSV
             #replacing[mt['dealer_name']] = self.contact_name
-            template = dlr_email_template
+            template = data.dlr_email_template
             assert self.dns is None
 
         # The template has some local path stuff mixed in, so we need to expand
@@ -376,6 +580,12 @@ class Notification(object):
 
 
 def dtable_query(dtable, index_field, index_id, output_field):
+    if isinstance(dtable, Table):
+        row = dtable.find(index_field, index_id)
+        if row is not None:
+            return row[output_field]
+        raise TableRecordNotFound(index_field, index_id)
+
     for row in dtable:
         if row[index_field] == index_id:
             return row[output_field]
@@ -383,6 +593,17 @@ def dtable_query(dtable, index_field, index_id, output_field):
         raise TableRecordNotFound(index_field, index_id)
 
 
+def normalize_tracking_number(tracknum):
+    return upsdata.normalize_tracking_number(tracknum)
+
+
+def check_tracking_number(tracking_number):
+    '''Raise TrackingNumberInvalid unless the number is a UPS number the
+    API can answer for (format and check digit), without contacting UPS.'''
+    upsdata.validate_ups_tracking_number(
+        tracking_number, verify_check_digit=params['ups_verify_check_digit'])
+
+
 def get_expected_date(tracking_number):
     '''check expected format, e.g., 1Z6351950343296108
      then pull up information from UPS-querying module'''
@@ -391,14 +612,9 @@ def get_expected_date(tracking_number):
     #import upsdata
 
     tracking_number = str(tracking_number)
-    # if completely numeric, it was converted to int earlier
-
-    if not tracking_number:
-        raise upsdata.TrackingNumberInvalid
-    elif len(tracking_number) == 12 and tracking_number.isdigit():
-        raise upsdata.TrackingNumberInvalid  # Fedex    
-    elif len(tracking_number) != 18 or tracking_number[0:2].upper() != "1Z":
-        raise upsdata.TrackingNumberInvalid  # Non-UPS-formatted, unknown
+    # (kept as text by the column schema, but be safe)
+
+    check_tracking_number(tracking_number)
     try:
         track_result = upsdata.tracking_info(userid=params['ups_userid'],
                                              password=params['ups_password'],
@@ -409,7 +625,9 @@ def get_expected_date(tracking_number):
         raise
 
 
-def send_internal_email(subject, content):
+def send_internal_email(subject, content, attachments=(), outbox=None):
+    '''Email the company address. Given an Outbox, the email is put in it
+    to be sent (and retried) like the customer emails.'''
     log("Sending internal email, subject: %s" % subject)
     if params['email_in_testing_mode']:
         recipient = params['test_email_recipient_as_contactupdating']
@@ -418,6 +636,14 @@ def send_internal_email(subject, content):
     #if not params['gmail_password']:
     #    params['gmail_password'] = getpass("Gmail password: ")
 
+    if outbox is not None:
+        message = build_email(params['email_from_name_for_internal_notes'],
+                              recipient, None, subject, content, attachments)
+        name = outbox.put(params['email_from_name_for_internal_notes'],
+                          recipient, message, subject=subject)
+        log("Internal email queued in the outbox as %s" % name)
+        return
+
     result = send_gmail(gmail_username=params['gmail_userid'],
                         gmail_pwd=params['gmail_password'],
                         send_from=params['email_from_name_for_internal_notes'],
@@ -426,13 +652,14 @@ def send_internal_email(subject, content):
                         subject=subject,
                         html_content=content,
                         simulation_mode=params['simulated_emails'],
+                        attachments=attachments,
                         )
     log(result)
 
 def get_address_fields(slip_id, string_if_empty):
 
     def query_slips(output_field):
-        qs = partial(dtable_query, dtable=pslips_dtable,
+        qs = partial(dtable_query, dtable=data.pslips,
                           index_field=pslips_heading['slip_id'],
                           index_id=slip_id)
         try:
@@ -469,7 +696,7 @@ def get_address_fields(slip_id, string_if_empty):
 def get_contact_email(customer_id):
     # Contact table information (often missing)
 
-    query_contact = partial(dtable_query, dtable=contacts_dtable,
+    query_contact = partial(dtable_query, dtable=data.contacts,
                             index_field=contacts_heading['cust_id'],
                             index_id=customer_id)
 
@@ -501,27 +728,375 @@ def get_contact_email(customer_id):
     return contact_email
 
 
-def run_job():
-
-    # Convert all convertable strings to a numeric type
-    for table in [contacts_dtable, shipments_dtable, pslips_dtable]:
-        for row in table:
-            for key in row.keys():
-                if row[key].isdigit():
-                    row[key] = int(row[key])
-
-    all_slip_ids = [r[pslips_heading['slip_id']]
-                    for r in pslips_dtable]
-    unique_slip_ids = sorted(set(all_slip_ids))
+def group_slip_rows(dtable):
+    '''Bucket packing slip rows by slip ID in a single pass.
+    Rows keep their file order within each slip.'''
+    slip_field = pslips_heading['slip_id']
+    groups = OrderedDict()
+    for row in dtable:
+        groups.setdefault(row[slip_field], []).append(row)
+    return groups
+
+
+def iter_slip_groups(csv_path):
+    '''Stream (slip_id, rows) pairs from a packing slip CSV, one slip at a
+    time, without loading the whole file. The export must keep each slip's
+    rows together (sorted or at least contiguous by slip ID); a slip ID that
+    shows up again after other slips raises SlipRowsNotContiguous.'''
+    slip_field = pslips_heading['slip_id']
+    seen = set()
+    with open(csv_path, 'rU') as csv_file:
+        missing, rows = read_projected_rows(csv_file, pslips_heading.values())
+        report_missing_columns(csv_path, missing)
+        converters = column_converters(pslips_heading, pslips_types)
+        rows = (convert_record(row, converters) for row in rows)
+        for slip_id, group in groupby(rows, key=lambda row: row[slip_field]):
+            if slip_id in seen:
+                raise SlipRowsNotContiguous(slip_id)
+            seen.add(slip_id)
+            yield slip_id, list(group)
+
+
+def prefetch_expected_dates(slips, window):
+    '''Pass (slip_id, rows) pairs through unchanged, looking up the
+    tracking numbers of each `window` slips together beforehand so that
+    get_expected_date finds them in upsdata.tracking_cache.'''
+    tracknum_field = pslips_heading['tracknum']
+    slips = iter(slips)
+    while True:
+        batch = list(islice(slips, window))
+        if not batch:
+            return
+        numbers = set()
+        for slip_id, slip_rows in batch:
+            tracking_number = normalize_tracking_number(slip_rows[0][tracknum_field])
+            try:
+                check_tracking_number(tracking_number)
+            except upsdata.TrackingNumberInvalid:
+                continue
+            numbers.add(tracking_number)
+        if numbers:
+            log("Looking up %d tracking number(s)" % len(numbers))
+            upsdata.prefetch_tracking_info(
+                userid=params['ups_userid'],
+                password=params['ups_password'],
+                access_license=params['ups_access_license'],
+                tracking_numbers=numbers,
+                concurrency=params['ups_concurrency'],
+                requests_per_second=params['ups_requests_per_second'])
+        for slip in batch:
+            yield slip
+
+
+def open_recheck_queue():
+    '''The RecheckQueue at params['recheck_file'], or None if it's off.'''
+    if not params.get('recheck_file'):
+        return None
+    return RecheckQueue(params['recheck_file'],
+                        interval=params['recheck_interval'],
+                        backoff=params['recheck_backoff'],
+                        interval_max=params['recheck_interval_max'],
+                        max_attempts=params['recheck_max_attempts'],
+                        deadline=params['recheck_deadline'])
+
+
+def open_outbox():
+    '''The Outbox at params['outbox_dir'], or None if it's off.'''
+    if not params.get('outbox_dir'):
+        return None
+    return Outbox(params['outbox_dir'],
+                  max_attempts=params['outbox_max_attempts'],
+                  retry_interval=params['outbox_retry_interval'],
+                  retry_backoff=params['outbox_retry_backoff'],
+                  retry_interval_max=params['outbox_retry_interval_max'])
+
+
+def log_outbox_depth(outbox):
+    log("Outbox: %d email(s) waiting, %d failed"
+        % (len(outbox), len(outbox.names('failed'))))
+
+
+def drain_outbox(outbox, ledger=None):
+    '''Try to send each email in the outbox that's due. Sent emails leave
+    the outbox and their slips are recorded in the ledger (unless they
+    went to a test address); failed ones wait for their next attempt.
+    Each email is claimed first, so drains running at once share the
+    outbox rather than sending its emails twice.'''
+    released = outbox.release_stale()
+    if released:
+        log("Outbox: %d email(s) left half-sent by an earlier drain put back"
+            % released)
+    names = outbox.due()
+    if names:
+        log("Sending %d email(s) from the outbox" % len(names))
+    sending = deque()
+
+    def finish(name, header, message, pending):
+        result = pending.result()
+        if header.get('slip_id') is not None:
+            log("Slip [%s]: %s" % (header['slip_id'], result))
+        else:
+            log("Internal email %r: %s" % (header.get('subject'), result))
+        if not result.startswith("Error"):
+            outbox.remove(name)
+            if (ledger is not None and header.get('slip_id') is not None
+                    and not header.get('testing')):
+                ledger.record(header['slip_id'], header.get('tracking_number'),
+                              header.get('sent_to'))
+        elif not outbox.retry_later(name, header, message, result):
+            log("Giving up on outbox email %s after %d attempts"
+                % (name, params['outbox_max_attempts']))
+
+    for name in names:
+        if not outbox.claim(name):
+            continue   # another drain is sending it
+        header, message = outbox.read(name, 'cur')
+        sending.append((name, header, message,
+                        queue_message(params['gmail_userid'],
+                                      params['gmail_password'],
+                                      header['send_from'], header['send_to'],
+                                      message)))
+        while sending and sending[0][3].done():
+            finish(*sending.popleft())
+    while sending:
+        finish(*sending.popleft())
+    log_outbox_depth(outbox)
+
+
+def drain_job():
+    '''Send what's due in the outbox, without reading the CSVs or asking
+    UPS. Returns when the next waiting email is due, or None if the outbox
+    is empty.'''
+    outbox = open_outbox()
+    if outbox is None:
+        log("No outbox configured (params['outbox_dir'])")
+        return None
+    ledger = None
+    if params.get('ledger_file'):
+        ledger = SlipLedger(params['ledger_file'])
+    start_sender_pool()
+    try:
+        drain_outbox(outbox, ledger)
+    finally:
+        stop_sender_pool()
+        if ledger is not None:
+            ledger.close()
+        mailer.close_transports()
+    return outbox.next_due()
+
+
+def report_failed_outbox(outbox, digest):
+    '''Add each slip whose email is in the outbox's failed/ folder to the
+    digest, so they're reported on every run until requeued.'''
+    failed = list(outbox.headers('failed'))
+    for name, header in failed:
+        if header.get('slip_id') is None:
+            log("Outbox email %s (%r) is in failed/" % (name, header.get('subject')))
+            continue
+        details = dict(header, outbox_file=os.path.join(outbox.path, 'failed', name))
+        digest.add(header['slip_id'], [outbox_failed_problem], details, '')
+    if failed:
+        log("Outbox: %d email(s) in failed/; \"python outbox.py requeue\" "
+            "tries them again" % len(failed))
+
+
+def expire_missing_slips(recheck, seen, digest):
+    '''Drop the slips in the recheck queue that aren't in `seen` (the
+    export) once they've expired, adding each to the digest.'''
+    expired = [slip_id for slip_id in sorted(recheck.waiting)
+               if slip_id not in seen and recheck.is_expired(slip_id)]
+    for slip_id in expired:
+        log("Slip [%s] is no longer in the packing slip export; giving up "
+            "waiting for a delivery date" % slip_id)
+        digest.add(slip_id, [not_in_export_problem], recheck.entry(slip_id), '')
+        recheck.remove(slip_id)
+    missing = sum(1 for slip_id in recheck.waiting if slip_id not in seen)
+    if missing:
+        log("%d slip(s) in the recheck queue are missing from the packing "
+            "slip export" % missing)
+
+
+def run_job(streaming=False, force=False, recheck_only=False,
+            spool_only=False):
+    '''Build and send a notification for every packing slip.
+
+    With streaming=True, slips are read straight from the packing slip CSV
+    by iter_slip_groups and each Notification is dropped once it has been
+    sent, so memory use doesn't grow with the size of the export.
+
+    Slips recorded in the ledger (params['ledger_file']) as already sent
+    are skipped unless force=True. Tracking numbers for the remaining
+    slips are looked up concurrently, params['ups_prefetch_window'] slips
+    at a time, before their notifications are built.
+
+    Slips UPS has no date for wait in the recheck queue
+    (params['recheck_file']) and are skipped until they're due to be looked
+    up again. With recheck_only=True, only the slips that are due are
+    processed, so the number of UPS lookups follows the number of slips
+    still waiting rather than the size of the export. Returns the time the
+    next slip in the queue is due, or None if none are waiting. Queued
+    slips missing from the export are reported with the slips that couldn't
+    be sent, and dropped, once they would have been sent anyway.
+
+    Customer emails are sent by a mailer.SenderPool of
+    params['smtp_connections'] sessions while the next notifications are
+    being built.
+
+    Slips that can't be sent are reported in one internal email at the end
+    (see ProblemDigest), along with slips whose emails the outbox has
+    given up on. Unless emails are simulated, customer emails are put in the outbox
+    (params['outbox_dir']) as they're built and sent from there at the end
+    of the run; with spool_only=True they're left for drain_job.'''
+
+    data.load(pslips=not streaming)
+    upsdata.lookup_metrics.clear()
+    upsdata.tracking_cache.reset_stats()
+    # numbers whose lookups failed last run get another try
+    upsdata.forget_failed_lookups()
+
+    if streaming:
+        slips = iter_slip_groups(params['packingslips_csv'])
+    else:
+        slip_groups = group_slip_rows(data.pslips)
+        slips = ((slip_id, slip_groups[slip_id])
+                 for slip_id in sorted(slip_groups))
+
+    ledger = None
+    if params.get('ledger_file'):
+        ledger = SlipLedger(params['ledger_file'])
+        log("%d slip(s) already sent according to %s"
+            % (len(ledger), params['ledger_file']))
+
+    # Sends to test addresses or simulation files don't count as sent
+    record_sends = not (params['simulated_emails']
+                        or params['email_in_testing_mode'])
+
+    # Likewise, only real runs hold slips back to wait for a date
+    recheck = open_recheck_queue() if record_sends else None
+    if recheck is not None:
+        log("%d slip(s) waiting for a delivery date, %d due for a recheck"
+            % (len(recheck), recheck.due_count()))
+
+    outbox = None if params['simulated_emails'] else open_outbox()
+    spooled = set()
+    if outbox is not None:
+        log_outbox_depth(outbox)
+        spooled = outbox.slip_ids()
+
+    # queued slips this run has seen in the export (or deferred)
+    rechecked = set()
+
+    def unsent(slips):
+        for slip_id, slip_rows in slips:
+            if ledger is not None and slip_id in ledger and not force:
+                log("Skipping slip [%s]: already sent" % slip_id)
+                if recheck is not None:
+                    recheck.remove(slip_id)
+                continue
+            if slip_id in spooled:
+                log("Skipping slip [%s]: already in the outbox" % slip_id)
+                if recheck is not None:
+                    recheck.remove(slip_id)
+                continue
+            if recheck is not None and slip_id in recheck:
+                rechecked.add(slip_id)
+                if not (recheck.is_due(slip_id) or force):
+                    continue
+                # ask UPS again rather than reuse the answer that put
+                # the slip in the queue
+                tracking_number = normalize_tracking_number(
+                    slip_rows[0][pslips_heading['tracknum']])
+                upsdata.forget_tracking_info(tracking_number)
+            elif recheck_only:
+                continue
+            yield slip_id, slip_rows
+
+    window = params['ups_prefetch_window']
+    if not window:
+        window = 1 if streaming else None   # None: all slips in one batch
+    slips = prefetch_expected_dates(unsent(slips), window)
 
     notifications = []
+    deferred_count = 0
+    digest = ProblemDigest()
+    sending = deque()   # notifications whose email is still queued
 
-    for slip_id in unique_slip_ids:
-        log('=' * 80)
-        log("Starting slip [%s]" % slip_id)
+    def finish(n):
+        n.finish_send()
+        if ledger is not None and n.sent and record_sends:
+            ledger.record(n.slip_id, n.tracking_number, n.contact_email)
 
-        n = Notification(slip_id)
-        notifications.append(n)
+    start_sender_pool()
+    try:
+        for slip_id, slip_rows in slips:
+            log('=' * 80)
+            log("Starting slip [%s]" % slip_id)
+
+            n = Notification(slip_id, slip_rows=slip_rows,
+                             wait_for_date=recheck is not None,
+                             last_chance=(recheck is not None
+                                          and recheck.is_last_chance(slip_id)),
+                             outbox=outbox, digest=digest)
+            deferred_count += n.deferred
+            if n.pending_send is not None:
+                sending.append(n)
+            else:
+                finish(n)
+            while sending and sending[0].pending_send.done():
+                finish(sending.popleft())
+            if recheck is not None:
+                if n.deferred:
+                    next_check = recheck.defer(n.slip_id, n.tracking_number,
+                                               n.deferred_reason)
+                    rechecked.add(n.slip_id)
+                    log("Slip [%s] will be looked up again after %s"
+                        % (n.slip_id, time.strftime("%Y/%m/%d %H:%M",
+                                                    time.localtime(next_check))))
+                else:
+                    recheck.remove(n.slip_id)
+            if not streaming:
+                notifications.append(n)
+        if recheck is not None:
+            expire_missing_slips(recheck, rechecked, digest)
+        if outbox is not None:
+            report_failed_outbox(outbox, digest)
+        if len(digest):
+            # through the outbox, so an SMTP failure doesn't lose it
+            send_internal_email(subject=digest.subject(),
+                                content=digest.summary_html(),
+                                attachments=[(digest.attachment_name(),
+                                              digest.details_html())],
+                                outbox=outbox)
+        if outbox is not None and not spool_only:
+            drain_outbox(outbox, ledger)
+        next_due = (recheck.next_due(rechecked) if recheck is not None
+                    else None)
+    finally:
+        # let queued emails go out and be recorded, even after an error
+        stop_sender_pool()
+        while sending:
+            finish(sending.popleft())
+        if ledger is not None:
+            ledger.close()
+        if recheck is not None:
+            recheck.close()
+        digest.close()
+        mailer.close_transports()
+        close_simulation_sink()
+
+    upsdata.close_clients()
+    summary = upsdata.lookup_metrics.summary()
+    log("UPS lookups: %d HTTP request(s) sent, %d answered from the store, "
+        "%d from cache" % (summary['requests'], summary['store_hits'],
+                           upsdata.tracking_cache.stats()['hits']))
+    for line in upsdata.lookup_metrics.report_lines():
+        log("UPS " + line)
+    if params.get('ups_metrics_file'):
+        upsdata.lookup_metrics.save_json(params['ups_metrics_file'])
+        log("UPS request timings saved to %s" % params['ups_metrics_file'])
+    if deferred_count:
+        log("%d slip(s) deferred until UPS has a delivery date" % deferred_count)
+    return next_due
 
 
 def log(line):
@@ -531,60 +1106,124 @@ def log(line):
     logging.info(line)
 
 
+# mailer.SenderPool for the gmail account while run_job is running
+sender_pool = None
+
+
 def send_gmail(gmail_username, gmail_pwd,
                send_from, send_to, cc_to,
-               subject, html_content, simulation_mode):
+               subject, html_content, simulation_mode, attachments=()):
     ''' send_from is the name associated with the account--
         it will show as being sent from the gmail account's 
-        address as well. '''
-
+        address as well. attachments are (filename, html) pairs. '''
+    return queue_gmail(gmail_username, gmail_pwd, send_from, send_to, cc_to,
+                       subject, html_content, simulation_mode,
+                       attachments).result()
+
+
+def queue_gmail(gmail_username, gmail_pwd,
+                send_from, send_to, cc_to,
+                subject, html_content, simulation_mode, attachments=(),
+                slip_id=None):
+    '''send_gmail, but returns a mailer.PendingSend for the result. While
+    sender_pool is running, the email is only queued for it. In simulation
+    mode the email is added to the run's mbox, indexed under slip_id.'''
+
+    message = build_email(send_from, send_to, cc_to, subject, html_content,
+                          attachments)
     if simulation_mode:
-        log("Using simulation mode.")
-        # save file
-        output_filename = "test_email_for_" + send_to
-
-        while os.path.exists(output_filename + '.html'):
-            output_filename += " next"
-
-        output_filename += '.html'
-
-        row = lambda text: "<P><B>%s</B></P>\n" % text
-        output = (row('TO: ' + repr(send_to)) +
-                  row('CC: ' + repr(cc_to)) +
-                  row('SUBJECT: ' + repr(subject)) +
-                  html_content)
-
-        with open(output_filename, "w") as out_file:
-            out_file.write(output)
-        result = "Simulated email saved as %s" % output_filename
+        sink = get_simulation_sink()
+        offset = sink.add(send_from, send_to, cc_to, subject, message,
+                          slip_id=slip_id)
+        return mailer.PendingSend.completed(
+            "Simulated email saved in %s at byte %d" % (sink.mbox_path, offset))
 
     else:
-        #set email metadata
-        msg = MIMEMultipart()
-        msg['From'] = send_from
-        msg['To'] = send_to
-        msg['CC'] = cc_to  
-        msg['Date'] = formatdate(localtime=True)
-        msg['Subject'] = subject
-
-        #attach email content, tagged as an HTML-based email
-        msg.attach(MIMEText(html_content, 'html'))
-
-        #log in to gmail outgoing server and submit
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        try:
-            server.ehlo()
-            server.starttls()
-            server.ehlo
-            login_result = server.login(gmail_username, gmail_pwd)
-            log("Email server login result:" + str(login_result))
-            server.sendmail(send_from, send_to, msg.as_string())
-            result = "Done: no errors reported by mail server."
-        except smtplib.SMTPException as e:
-            result = "Error reported by email server: %s" % str(e)
-        finally:
-            server.quit()
-    return result
+        return queue_message(gmail_username, gmail_pwd, send_from, send_to,
+                             message)
+
+
+# SimulationSink for this run's simulated emails; opened on first use
+simulation_sink = None
+
+
+def get_simulation_sink():
+    global simulation_sink
+    if simulation_sink is None:
+        simulation_sink = SimulationSink(params['simulated_emails_dir'])
+        log("Simulated emails go to %s (index: %s)"
+            % (simulation_sink.mbox_path, simulation_sink.index_path))
+    return simulation_sink
+
+
+def close_simulation_sink():
+    global simulation_sink
+    if simulation_sink is not None:
+        log("%d simulated email(s) saved in %s"
+            % (simulation_sink.count, simulation_sink.mbox_path))
+        simulation_sink.close()
+        simulation_sink = None
+
+
+def build_email(send_from, send_to, cc_to, subject, html_content,
+                attachments=()):
+    '''The email as text, ready for sendmail. attachments are (filename,
+    html) pairs.'''
+    #set email metadata
+    msg = MIMEMultipart()
+    msg['From'] = send_from
+    msg['To'] = send_to
+    msg['CC'] = cc_to  
+    msg['Date'] = formatdate(localtime=True)
+    msg['Subject'] = subject
+
+    #attach email content, tagged as an HTML-based email
+    msg.attach(MIMEText(html_content, 'html'))
+    for filename, attachment in attachments:
+        part = MIMEText(attachment, 'html')
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        msg.attach(part)
+    return msg.as_string()
+
+
+def queue_message(gmail_username, gmail_pwd, send_from, send_to, message):
+    '''Send an email made by build_email, through sender_pool if it's
+    running for this account. Returns a mailer.PendingSend.'''
+    if (sender_pool is not None and sender_pool.username == gmail_username
+            and sender_pool.password == gmail_pwd):
+        return sender_pool.submit(send_from, send_to, message)
+
+    #submit through the run's logged-in session with the gmail server
+    transport = mailer.get_transport(
+        params['smtp_host'], params['smtp_port'],
+        gmail_username, gmail_pwd,
+        max_messages=params['smtp_messages_per_connection'],
+        timeout=params['smtp_timeout'], log=log)
+    return mailer.PendingSend.completed(
+        mailer.send_result(transport, send_from, send_to, message))
+
+
+def start_sender_pool():
+    '''Start sender_pool for the gmail account, unless
+    params['smtp_connections'] is 1 or emails are simulated.'''
+    global sender_pool
+    if params['smtp_connections'] > 1 and not params['simulated_emails']:
+        sender_pool = mailer.SenderPool(
+            params['smtp_host'], params['smtp_port'],
+            params['gmail_userid'], params['gmail_password'],
+            connections=params['smtp_connections'],
+            per_minute=params['smtp_messages_per_minute'],
+            per_connection_per_minute=params['smtp_messages_per_minute_per_connection'],
+            max_messages=params['smtp_messages_per_connection'],
+            timeout=params['smtp_timeout'], log=log)
+
+
+def stop_sender_pool():
+    '''Let the emails queued for sender_pool go out, then close it.'''
+    global sender_pool
+    if sender_pool is not None:
+        sender_pool.close()
+        sender_pool = None
 
 
 def test(slip_id="9990007"):
@@ -604,6 +1243,28 @@ def main():
     parser.add_argument('--password', dest='gmail_pass', type=str,
                         help="gmail password (username is hard-coded in parameters)",
                         required=False)
+    parser.add_argument('--stream', dest='streaming', action='store_true',
+                        help="read packing slips one slip at a time (the CSV "
+                             "must keep each slip's rows together)")
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help="also process slips the ledger lists as sent, "
+                             "and slips in the recheck queue that aren't due")
+    parser.add_argument('--recheck', dest='recheck_only', action='store_true',
+                        help="only look up slips in the recheck queue that "
+                             "are due")
+    parser.add_argument('--spool-only', dest='spool_only', action='store_true',
+                        help="leave customer emails in the outbox for --drain")
+    parser.add_argument('--drain', dest='drain', action='store_true',
+                        help="only send the emails waiting in the outbox")
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help="with --recheck or --drain, keep running until "
+                             "the recheck queue or outbox is empty, sleeping "
+                             "until the next slip or email is due")
+    parser.add_argument('--ups-url', dest='ups_url', type=str,
+                        help="send tracking requests to this URL instead of "
+                             "UPS (e.g. a local upsdata/standin.py server)")
+    parser.add_argument('--ups-metrics', dest='ups_metrics_file', type=str,
+                        help="save UPS request timings to this JSON file")
 
     args = parser.parse_args()
     
@@ -614,7 +1275,27 @@ def main():
 
     #params['gmail_password'] = args.gmail_pass
 
-    run_job()
+    if args.ups_url:
+        upsdata.options['tracking_url'] = args.ups_url
+    if args.ups_metrics_file:
+        params['ups_metrics_file'] = args.ups_metrics_file
+
+    if args.drain:
+        job = drain_job
+        next_due = drain_job()
+    else:
+        job = partial(run_job, streaming=args.streaming, recheck_only=True,
+                      spool_only=args.spool_only)
+        next_due = run_job(streaming=args.streaming, force=args.force,
+                           recheck_only=args.recheck_only,
+                           spool_only=args.spool_only)
+    while (args.watch and (args.recheck_only or args.drain)
+           and next_due is not None):
+        wait = max(0, next_due - time.time())
+        log("Next %s in %d minute(s)"
+            % ('send attempt' if args.drain else 'recheck', wait // 60))
+        time.sleep(wait)
+        next_due = job()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+'''Spool directory of rendered emails waiting to be delivered.
+
+main.run_job writes each customer email here instead of sending it while
+the notifications are built; main.drain_outbox then delivers whatever is
+waiting, at the end of the run or on its own with "main.py --drain". A
+message that can't be sent stays in the outbox and is tried again after
+retry_interval seconds, then retry_backoff times longer each time (at
+most retry_interval_max), and is moved to failed/ after max_attempts.
+Nothing has to be looked up or rendered again to retry it.
+
+Each message is one file in new/: a line of JSON (who it's for, which
+slip, attempts so far, when to try next) followed by the message text.
+Files are written to tmp/ first and renamed into place, so a crash never
+leaves a partial message in new/. A drain claims a message by renaming it
+into cur/ before sending it, so two drains running at once never send
+the same message; one that's been in cur/ for claim_timeout seconds (its
+drain died) is put back in new/.
+
+run as: "python outbox.py status"
+    or: "python outbox.py list [--failed]"
+    or: "python outbox.py requeue"     (move failed/ messages back to new/)
+'''
+
+import errno
+import json
+import os
+import threading
+import time
+
+from config import params
+
+
+class Outbox(object):
+
+    def __init__(self, path, max_attempts=None, retry_interval=60,
+                 retry_backoff=2, retry_interval_max=None, claim_timeout=3600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.retry_backoff = retry_backoff
+        self.retry_interval_max = retry_interval_max
+        self.claim_timeout = claim_timeout
+        for folder in ('tmp', 'new', 'cur', 'failed'):
+            folder_path = os.path.join(path, folder)
+            if not os.path.isdir(folder_path):
+                os.makedirs(folder_path)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        '''Messages waiting to be sent (the spool depth).'''
+        return len(self.names())
+
+    def names(self, folder='new'):
+        return sorted(name for name in os.listdir(os.path.join(self.path, folder))
+                      if not name.startswith('.'))
+
+    def new_name(self):
+        with self.lock:
+            self.counter += 1
+            return '%.6f.%d.%d' % (time.time(), os.getpid(), self.counter)
+
+    def write(self, folder, name, header, message):
+        tmp_path = os.path.join(self.path, 'tmp', name)
+        with open(tmp_path, 'wb') as spool_file:
+            spool_file.write(json.dumps(header) + '\n')
+            spool_file.write(message)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.rename(tmp_path, os.path.join(self.path, folder, name))
+
+    def read(self, name, folder='new'):
+        '''(header, message) of a spooled message.'''
+        with open(os.path.join(self.path, folder, name), 'rb') as spool_file:
+            header = json.loads(spool_file.readline())
+            return header, spool_file.read()
+
+    def read_header(self, name, folder='new'):
+        with open(os.path.join(self.path, folder, name), 'rb') as spool_file:
+            return json.loads(spool_file.readline())
+
+    def headers(self, folder='new'):
+        '''(name, header) of each message in a folder, leaving out any a
+        drain claims while they're being read.'''
+        for name in self.names(folder):
+            try:
+                yield name, self.read_header(name, folder)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def put(self, send_from, send_to, message, **info):
+        '''Spool a message (as text) for sendmail(send_from, send_to, ...).
+        `info` (slip_id and so on) is kept with it for whoever sends it.'''
+        name = self.new_name()
+        header = dict(info, send_from=send_from, send_to=send_to, attempts=0,
+                      queued_at=time.time(), next_attempt=0, last_error=None)
+        self.write('new', name, header, message)
+        return name
+
+    def due(self, now=None):
+        '''Names of the messages ready to be tried, oldest first.'''
+        if now is None:
+            now = time.time()
+        return [name for name, header in self.headers()
+                if header['next_attempt'] <= now]
+
+    def next_due(self):
+        '''When the next waiting message is ready, or None if none are.'''
+        times = [header['next_attempt'] for name, header in self.headers()]
+        return min(times) if times else None
+
+    def slip_ids(self):
+        '''Slip IDs of the messages waiting, being sent or given up on.'''
+        return set(header.get('slip_id') for folder in ('new', 'cur', 'failed')
+                   for name, header in self.headers(folder))
+
+    def claim(self, name):
+        '''Move a message from new/ to cur/ to send it. False if another
+        drain got to it first.'''
+        claimed_path = os.path.join(self.path, 'cur', name)
+        try:
+            os.rename(os.path.join(self.path, 'new', name), claimed_path)
+        except OSError:
+            return False
+        # the claim's age is the file's mtime (see release_stale)
+        os.utime(claimed_path, None)
+        return True
+
+    def release_stale(self, now=None):
+        '''Put messages claimed over claim_timeout seconds ago back in
+        new/; returns how many.'''
+        if now is None:
+            now = time.time()
+        released = 0
+        for name in self.names('cur'):
+            claimed_path = os.path.join(self.path, 'cur', name)
+            try:
+                if os.path.getmtime(claimed_path) > now - self.claim_timeout:
+                    continue
+                os.rename(claimed_path, os.path.join(self.path, 'new', name))
+            except OSError:
+                continue   # sent or released meanwhile
+            released += 1
+        return released
+
+    def remove(self, name):
+        '''Delete a claimed message (it's been sent).'''
+        os.remove(os.path.join(self.path, 'cur', name))
+
+    def retry_later(self, name, header, message, error):
+        '''Note a failed attempt at a claimed message, putting it back in
+        new/. Returns False if the message has now used up its attempts and
+        was moved to failed/.'''
+        header = dict(header, attempts=header['attempts'] + 1,
+                      last_error=error)
+        if self.max_attempts and header['attempts'] >= self.max_attempts:
+            self.write('failed', name, header, message)
+            self.remove(name)
+            return False
+        wait = self.retry_interval * self.retry_backoff ** (header['attempts'] - 1)
+        if self.retry_interval_max:
+            wait = min(wait, self.retry_interval_max)
+        header['next_attempt'] = time.time() + wait
+        self.write('new', name, header, message)
+        self.remove(name)
+        return True
+
+    def requeue_failed(self):
+        '''Move every message in failed/ back to new/ with its attempts
+        reset; returns how many were moved.'''
+        names = self.names('failed')
+        for name in names:
+            header, message = self.read(name, 'failed')
+            header = dict(header, attempts=0, next_attempt=0)
+            self.write('new', name, header, message)
+            os.remove(os.path.join(self.path, 'failed', name))
+        return len(names)
+
+
+def main():
+    import argparse
+
+    def timestamp(seconds):
+        return time.strftime("%Y/%m/%d %H:%M", time.localtime(seconds))
+
+    parser = argparse.ArgumentParser(description='Inspect the outbox of '
+                                     'emails waiting to be sent.')
+    parser.add_argument('--dir', default=params['outbox_dir'],
+                        help="outbox directory (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('status', help="count waiting and failed messages")
+    list_parser = commands.add_parser('list', help="show waiting messages")
+    list_parser.add_argument('--failed', action='store_true',
+                             help="show failed messages instead")
+    commands.add_parser('requeue', help="try failed messages again")
+
+    args = parser.parse_args()
+    outbox = Outbox(args.dir)
+    if args.command == 'status':
+        print "%d waiting, %d being sent, %d failed" % (
+            len(outbox), len(outbox.names('cur')), len(outbox.names('failed')))
+    elif args.command == 'list':
+        folder = 'failed' if args.failed else 'new'
+        names = outbox.names(folder)
+        for name in names:
+            header = outbox.read_header(name, folder)
+            print "%s  slip %-8s %-30s attempts %d, next %s  %s" % (
+                timestamp(header['queued_at']), header.get('slip_id'),
+                header['send_to'], header['attempts'],
+                timestamp(header['next_attempt']) if header['next_attempt'] else 'now',
+                header['last_error'] or '')
+        print "%d messages" % len(names)
+    else:
+        print "%d messages requeued" % outbox.requeue_failed()
+
+
+if __name__ == '__main__':
+    main()
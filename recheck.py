@@ -0,0 +1,121 @@
+'''Packing slips waiting for UPS to give a delivery date.
+
+When UPS has no date for a package, or the lookup fails, main.run_job
+holds the slip's notification back and puts the slip here instead of
+emailing "date unavailable". The slip is looked up again once its
+next_check time comes round, at growing intervals, and sent when a date
+arrives. After max_attempts lookups, or once the slip has waited for
+`deadline` seconds, it's sent with whatever UPS said last. A slip that
+drops out of the packing slip export while it waits can't be looked up
+or sent; it's given up on (expired) at the same point.
+
+The queue is a small sqlite file (params['recheck_file']).
+'''
+
+import sqlite3
+import time
+
+
+class RecheckQueue(object):
+
+    def __init__(self, path, interval, backoff=2, interval_max=None,
+                 max_attempts=None, deadline=None):
+        self.path = path
+        self.interval = interval
+        self.backoff = backoff
+        self.interval_max = interval_max
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS recheck_slips ('
+                          ' slip_id INTEGER PRIMARY KEY,'
+                          ' tracking_number TEXT,'
+                          ' reason TEXT,'
+                          ' attempts INTEGER,'
+                          ' first_seen REAL,'
+                          ' next_check REAL)')
+        self.conn.commit()
+        # read once per run, like SlipLedger; slip_id -> (attempts,
+        # first_seen, next_check)
+        self.waiting = dict((row[0], row[1:]) for row in self.conn.execute(
+            'SELECT slip_id, attempts, first_seen, next_check FROM recheck_slips'))
+
+    def __contains__(self, slip_id):
+        return slip_id in self.waiting
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def is_due(self, slip_id, now=None):
+        if now is None:
+            now = time.time()
+        return self.waiting[slip_id][2] <= now
+
+    def due_count(self, now=None):
+        if now is None:
+            now = time.time()
+        return sum(1 for entry in self.waiting.values() if entry[2] <= now)
+
+    def next_due(self, slip_ids=None):
+        '''Time of the earliest next_check, or None if nothing is waiting.
+        Given slip_ids, only those slips are considered.'''
+        times = [entry[2] for slip_id, entry in self.waiting.items()
+                 if slip_ids is None or slip_id in slip_ids]
+        return min(times) if times else None
+
+    def is_last_chance(self, slip_id, now=None):
+        '''True if the coming lookup is the last one the slip waits for:
+        it has used up its attempts or passed its deadline.'''
+        if slip_id not in self.waiting:
+            return False
+        if now is None:
+            now = time.time()
+        attempts, first_seen, next_check = self.waiting[slip_id]
+        if self.max_attempts and attempts + 1 >= self.max_attempts:
+            return True
+        return bool(self.deadline) and now >= first_seen + self.deadline
+
+    def is_expired(self, slip_id, now=None):
+        '''True if a slip that can no longer be looked up has waited as
+        long as it would have: it's at its last chance, or (with no
+        deadline) its next check is due.'''
+        if now is None:
+            now = time.time()
+        return (self.is_last_chance(slip_id, now)
+                or (not self.deadline and self.is_due(slip_id, now)))
+
+    def entry(self, slip_id):
+        '''A waiting slip's row, as a dict.'''
+        cursor = self.conn.execute('SELECT * FROM recheck_slips '
+                                   'WHERE slip_id = ?', (slip_id,))
+        names = [column[0] for column in cursor.description]
+        return dict(zip(names, cursor.fetchone()))
+
+    def defer(self, slip_id, tracking_number, reason):
+        '''Record another lookup without a date and schedule the next one,
+        interval * backoff**(attempts - 1) seconds from now.'''
+        now = time.time()
+        attempts, first_seen, next_check = self.waiting.get(slip_id, (0, now, now))
+        attempts += 1
+        wait = self.interval * self.backoff ** (attempts - 1)
+        if self.interval_max:
+            wait = min(wait, self.interval_max)
+        next_check = now + wait
+        self.conn.execute('INSERT OR REPLACE INTO recheck_slips '
+                          'VALUES (?, ?, ?, ?, ?, ?)',
+                          (slip_id, tracking_number, reason, attempts,
+                           first_seen, next_check))
+        self.conn.commit()
+        self.waiting[slip_id] = (attempts, first_seen, next_check)
+        return next_check
+
+    def remove(self, slip_id):
+        if slip_id not in self.waiting:
+            return
+        self.conn.execute('DELETE FROM recheck_slips WHERE slip_id = ?',
+                          (slip_id,))
+        self.conn.commit()
+        del self.waiting[slip_id]
+
+    def close(self):
+        self.conn.close()
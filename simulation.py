@@ -0,0 +1,67 @@
+'''Where emails go when params['simulated_emails'] is on.
+
+Each run writes every email it would have sent, exactly as it would have
+been sent, to one mbox file, and a line of JSON per email to an index
+beside it: slip ID, recipients, subject, and the byte offset and length
+of the message in the mbox. Both are named after the time the run
+started, e.g. simulated_emails/20141224_093000.mbox and .jsonl, so two
+runs can be compared by diffing their indexes (or mboxes, which any mail
+client can open).
+'''
+
+import json
+import os
+import re
+import threading
+import time
+from email.utils import parseaddr
+
+from_line = re.compile(r'^(>*From )', re.MULTILINE)
+
+
+class SimulationSink(object):
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, time.strftime("%Y%m%d_%H%M%S"))
+        # a second run in the same second gets its own files
+        suffix = 0
+        while os.path.exists(base + ('_%d' % suffix if suffix else '') + '.mbox'):
+            suffix += 1
+        if suffix:
+            base += '_%d' % suffix
+        self.mbox_path = base + '.mbox'
+        self.index_path = base + '.jsonl'
+        self.mbox = open(self.mbox_path, 'wb')
+        self.index = open(self.index_path, 'wb')
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, send_from, send_to, cc_to, subject, message, slip_id=None):
+        '''Append a message (as text) to the mbox and index it. Returns its
+        byte offset in the mbox.'''
+        # mboxrd: quote body lines that would read as the start of a message
+        body = from_line.sub(r'>\1', message.rstrip('\n'))
+        # the From_ line wants a bare address; a sender that's only a name
+        # (params['email_from_name'] can be) gets the usual placeholder
+        address = parseaddr(send_from)[1]
+        if '@' not in address:
+            address = 'MAILER-DAEMON'
+        entry = 'From %s %s\n%s\n\n' % (address, time.asctime(), body)
+        with self.lock:
+            offset = self.mbox.tell()
+            self.mbox.write(entry)
+            self.mbox.flush()
+            self.index.write(json.dumps(
+                {'slip_id': slip_id, 'to': send_to, 'cc': cc_to,
+                 'subject': subject, 'offset': offset,
+                 'length': len(entry)}, sort_keys=True) + '\n')
+            self.index.flush()
+            self.count += 1
+        return offset
+
+    def close(self):
+        with self.lock:
+            self.mbox.close()
+            self.index.close()
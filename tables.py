@@ -0,0 +1,429 @@
+'''Compact, column-oriented storage for the CSV tables used by main.py.
+
+A Table keeps one list per column instead of one dict per row, and shares
+repeated cell values within a column, so a loaded export costs a few
+pointers per cell. Rows are handed out as TableRow views that support the
+same row[column_name] lookups as the csv.DictReader dicts they replace.
+
+Loaders can be given the list of columns the program actually reads (the
+values of a config heading map); every other column is skipped as soon as
+the header has been read.
+
+Large files can be parsed in parallel (Table.from_csv_parallel): the file
+is cut into byte ranges that end on record boundaries, each range is
+parsed in a worker process, and the columns are joined in file order.
+
+Parsed tables can be saved as pickle snapshots and reloaded on later runs
+for as long as the source CSV is unchanged (see load_snapshot).
+'''
+
+import csv
+import hashlib
+import multiprocessing
+import os
+import cPickle as pickle
+from datetime import datetime
+
+
+class Table(object):
+    '''Column-oriented table with first-match hash indexes.
+
+    Column names are resolved to positions once, from the header row. When
+    a header repeats a name (PACKINGSLIPS has two "Customer" columns) the
+    right-most column wins, matching what csv.DictReader did before.'''
+
+    def __init__(self, header, columns, missing_columns=()):
+        self.header = list(header)
+        self.columns = columns
+        self.positions = dict((name, i) for i, name in enumerate(self.header))
+        self.missing_columns = list(missing_columns)
+        self.indexes = {}
+
+    @classmethod
+    def from_csv(cls, csv_file, keep_columns=None):
+        '''Load a table from an open CSV file. If keep_columns is given,
+        only those columns are stored; any of them not in the file's header
+        are listed in missing_columns.'''
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        names, source_positions, missing = project_header(header, keep_columns)
+        columns = read_columns(reader, len(header), source_positions)
+        return cls(names, columns, missing)
+
+    @classmethod
+    def from_csv_parallel(cls, csv_path, keep_columns=None, workers=None):
+        '''Load a table like from_csv, parsing byte ranges of the file in
+        a pool of worker processes (one per CPU if workers is None). The
+        result is the same as from_csv on the file opened with 'rU'.'''
+        workers = workers or multiprocessing.cpu_count()
+        header_end, boundaries = record_boundaries(csv_path, workers)
+        with open(csv_path, 'rb') as csv_file:
+            header_text = normalize_newlines(csv_file.read(header_end))
+        header = next(csv.reader(header_text.splitlines(True)), [])
+        names, source_positions, missing = project_header(header, keep_columns)
+
+        ranges = zip([header_end] + boundaries, boundaries + [None])
+        jobs = [(csv_path, start, end, len(header), source_positions)
+                for start, end in ranges]
+        if len(jobs) == 1:
+            pieces = map(parse_range, jobs)
+        else:
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+            try:
+                pieces = pool.map(parse_range, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        # values come back from the workers as separate copies per range;
+        # share them across ranges as read_columns does within one
+        columns = [[] for _ in names]
+        shared = [{} for _ in names]
+        for piece in pieces:
+            for column, values, part in zip(columns, shared, piece):
+                column.extend([values.setdefault(value, value)
+                               for value in part])
+        return cls(names, columns, missing)
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(self.columns[0])
+
+    def __iter__(self):
+        for position in xrange(len(self)):
+            yield TableRow(self, position)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return TableRow(self, position)
+
+    def column(self, name):
+        return self.columns[self.positions[name]]
+
+    def convert_columns(self, converters):
+        '''Convert columns in place; converters maps column names to one of
+        the functions in CONVERTERS. Each distinct value in a column is
+        converted once. Returns {column name: [values left unconverted]}.
+        Existing indexes are dropped since their keys may no longer match.'''
+        rejected = {}
+        for name, convert in converters.items():
+            if name not in self.positions:
+                continue
+            column = self.column(name)
+            converted = {}
+            for value in set(column):
+                try:
+                    converted[value] = convert(value)
+                except ValueError:
+                    converted[value] = value
+                    rejected.setdefault(name, []).append(value)
+            column[:] = [converted[value] for value in column]
+        self.indexes = {}
+        return rejected
+
+    def build_index(self, field):
+        index = {}
+        for position, value in enumerate(self.column(field)):
+            index.setdefault(value, position)
+        self.indexes[field] = index
+        return index
+
+    def build_indexes(self, fields):
+        for field in fields:
+            self.build_index(field)
+
+    def find(self, field, value):
+        '''Return the first row whose field equals value, or None.'''
+        index = self.indexes.get(field)
+        if index is None:
+            index = self.build_index(field)
+        position = index.get(value)
+        if position is None:
+            return None
+        return TableRow(self, position)
+
+
+def read_columns(records, header_length, source_positions):
+    '''Collect the values at source_positions from parsed CSV records into
+    one list per column, sharing repeated values within each column.'''
+    columns = [[] for _ in source_positions]
+    shared = [{} for _ in source_positions]
+    for record in records:
+        if not record:
+            continue  # blank line; DictReader skipped these too
+        # short rows are padded the way DictReader filled in missing keys
+        record += [''] * (header_length - len(record))
+        for column, values, i in zip(columns, shared, source_positions):
+            value = record[i]
+            column.append(values.setdefault(value, value))
+    return columns
+
+
+def normalize_newlines(text):
+    # the same translation a file opened with 'rU' applies
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def record_boundaries(csv_path, parts, block_size=1 << 20):
+    '''Find where to split a CSV file into about `parts` byte ranges.
+
+    Returns (header_end, boundaries): the offset just past the header
+    record and a sorted list of offsets that each start a new record. A
+    newline only ends a record when an even number of quote characters
+    comes before it (escaped quotes are doubled, so they don't change
+    that count), which keeps quoted fields with line breaks in one piece.'''
+    size = os.path.getsize(csv_path)
+    with open(csv_path, 'rb') as csv_file:
+        header_end, quotes = next_record_start(csv_file, 0, 0, block_size)
+        if header_end is None:
+            return size, []
+        step = (size - header_end) // parts
+        boundaries = []
+        last = header_end
+        for i in range(1, parts):
+            target = header_end + step * i
+            if step == 0 or target <= last:
+                continue
+            # a record starting at or after target ends a line at target-1 on
+            quotes += count_quotes(csv_file, last, target - 1, block_size)
+            boundary, quotes = next_record_start(csv_file, target - 1, quotes,
+                                                 block_size)
+            if boundary is None or boundary >= size:
+                break
+            boundaries.append(boundary)
+            last = boundary
+    return header_end, boundaries
+
+
+def count_quotes(csv_file, start, end, block_size):
+    csv_file.seek(start)
+    quotes = 0
+    remaining = end - start
+    while remaining > 0:
+        block = csv_file.read(min(block_size, remaining))
+        if not block:
+            break
+        quotes += block.count('"')
+        remaining -= len(block)
+    return quotes
+
+
+def next_record_start(csv_file, offset, quotes, block_size):
+    '''Scan from offset, with `quotes` quote characters before it, to the
+    first newline outside quotes. Returns (offset just past that newline,
+    quote count there), or (None, quotes) at end of file.'''
+    csv_file.seek(offset)
+    while True:
+        block = csv_file.read(block_size)
+        if not block:
+            return None, quotes
+        position = 0
+        while True:
+            newline = block.find('\n', position)
+            if newline == -1:
+                quotes += block.count('"', position)
+                break
+            quotes += block.count('"', position, newline)
+            position = newline + 1
+            if quotes % 2 == 0:
+                return offset + position, quotes
+        offset += len(block)
+
+
+def parse_range(job):
+    '''Worker for Table.from_csv_parallel: parse the records in one byte
+    range of a CSV file and return its columns.'''
+    csv_path, start, end, header_length, source_positions = job
+    with open(csv_path, 'rb') as csv_file:
+        csv_file.seek(start)
+        if end is None:
+            text = csv_file.read()
+        else:
+            text = csv_file.read(end - start)
+    lines = normalize_newlines(text).splitlines(True)
+    return read_columns(csv.reader(lines), header_length, source_positions)
+
+
+def to_int(value):
+    value = value.strip()
+    if not value:
+        return ''
+    return int(value)
+
+
+def to_date(value):
+    value = value.strip()
+    if not value:
+        return ''
+    return datetime.strptime(value, '%m/%d/%Y').date()
+
+
+# Converters for the column types named in config.py. Blank cells stay ''
+# for every type; a value that can't be converted is left as text.
+CONVERTERS = {
+    'int': to_int,
+    'str': str,
+    'date': to_date,
+    }
+
+
+def converters_key(converters):
+    '''Describe a {column name: converter} map for a snapshot's build_key:
+    which converter each column gets, and that converter's code, so both
+    a changed *_types map in config.py and a changed converter make old
+    snapshots miss.'''
+    def code_digest(code, digest):
+        digest.update(code.co_code)
+        for const in code.co_consts:
+            # a nested function's repr has its address in it
+            if hasattr(const, 'co_code'):
+                code_digest(const, digest)
+            else:
+                digest.update(repr(const))
+        return digest
+
+    def describe(convert):
+        code = getattr(convert, 'func_code', None)
+        if code is None:   # a builtin such as str
+            return convert.__name__
+        return '%s:%s' % (convert.__name__,
+                          code_digest(code, hashlib.sha1()).hexdigest()[:12])
+    return sorted((name, describe(convert))
+                  for name, convert in converters.items())
+
+
+def convert_record(record, converters):
+    '''Convert the values of one row dict in place, as
+    Table.convert_columns does for a whole table.'''
+    for name, convert in converters.items():
+        if name in record:
+            try:
+                record[name] = convert(record[name])
+            except ValueError:
+                pass
+    return record
+
+
+def project_header(header, keep_columns=None):
+    '''Work out which positions of a CSV header to read.
+
+    Returns (names, positions, missing): the column names to keep, the
+    position each is read from, and the requested names not in the header.
+    A name that appears more than once in the header is read from its
+    right-most position.'''
+    rightmost = dict((name, i) for i, name in enumerate(header))
+    if keep_columns is None:
+        names = [name for i, name in enumerate(header) if rightmost[name] == i]
+        missing = []
+    else:
+        wanted = set(keep_columns)
+        names = [name for i, name in enumerate(header)
+                 if name in wanted and rightmost[name] == i]
+        missing = sorted(wanted.difference(rightmost))
+    return names, [rightmost[name] for name in names], missing
+
+
+def read_projected_rows(csv_file, keep_columns=None):
+    '''Read a CSV header and return (missing, rows), where rows is an
+    iterator of dicts holding only keep_columns and missing lists the
+    requested columns that aren't in the header.'''
+    reader = csv.reader(csv_file)
+    header = next(reader)
+    names, source_positions, missing = project_header(header, keep_columns)
+    pairs = zip(names, source_positions)
+
+    def rows():
+        for record in reader:
+            if not record:
+                continue  # blank line; DictReader skipped these too
+            record += [''] * (len(header) - len(record))
+            yield dict((name, record[i]) for name, i in pairs)
+
+    return missing, rows()
+
+
+class TableRow(object):
+    '''Lightweight view of one row of a Table.'''
+
+    __slots__ = ('table', 'position')
+
+    def __init__(self, table, position):
+        self.table = table
+        self.position = position
+
+    def __getitem__(self, name):
+        table = self.table
+        return table.columns[table.positions[name]][self.position]
+
+    def __setitem__(self, name, value):
+        table = self.table
+        table.columns[table.positions[name]][self.position] = value
+
+    def __contains__(self, name):
+        return name in self.table.positions
+
+    def keys(self):
+        return list(self.table.positions)
+
+    def get(self, name, default=None):
+        if name in self.table.positions:
+            return self[name]
+        return default
+
+    def __repr__(self):
+        return repr(dict((name, self[name]) for name in self.keys()))
+
+
+# Bump when Table's pickled layout changes, so old snapshots are rebuilt.
+SNAPSHOT_VERSION = 1
+
+
+def file_fingerprint(path):
+    '''Identify the current contents of a file by its path, size,
+    modification time and SHA-1 hash.'''
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(1 << 20), ''):
+            digest.update(block)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime,
+            digest.hexdigest())
+
+
+def snapshot_path(cache_dir, csv_path, build_key):
+    '''Snapshot file for one CSV loaded one way; build_key describes how
+    the table was built (columns kept, types, indexes).'''
+    key = repr((SNAPSHOT_VERSION, os.path.abspath(csv_path), build_key))
+    name = '%s.%s.pickle' % (os.path.basename(csv_path),
+                             hashlib.sha1(key).hexdigest()[:16])
+    return os.path.join(cache_dir, name)
+
+
+def load_snapshot(cache_dir, csv_path, build_key, fingerprint):
+    '''Return the Table saved for csv_path if its snapshot was taken
+    from a file with the same fingerprint, otherwise None.'''
+    try:
+        with open(snapshot_path(cache_dir, csv_path, build_key), 'rb') as f:
+            saved_fingerprint, table = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError, ValueError,
+            AttributeError, ImportError):
+        return None
+    if saved_fingerprint != fingerprint:
+        return None
+    return table
+
+
+def save_snapshot(cache_dir, csv_path, build_key, fingerprint, table):
+    '''Write a snapshot of table, replacing any older one in one step so
+    a crash never leaves a half-written snapshot behind.'''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    target = snapshot_path(cache_dir, csv_path, build_key)
+    temp = '%s.%d.tmp' % (target, os.getpid())
+    with open(temp, 'wb') as f:
+        pickle.dump((fingerprint, table), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp, target)
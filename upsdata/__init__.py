@@ -1 +1,4 @@
-from upsdata import *
\ No newline at end of file
+from upsdata import *
+from prefetch import prefetch_tracking_info
+from validate import (normalize_tracking_number, identify_carrier,
+                      validate_ups_tracking_number)
@@ -0,0 +1,101 @@
+'''Small in-memory cache for UPS lookup results.
+
+Entries are dropped least-recently-used first once the cache is full, and
+after `ttl` seconds if a ttl is given. Both return values and exceptions
+can be stored, so an invalid tracking number is remembered as well as a
+delivery date. A cache can be shared between threads.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LookupCache(object):
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> (stored_at, is_error, value)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._entry(key) is not None
+
+    def _entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry[0] > self.ttl:
+            del self.entries[key]
+            return None
+        return entry
+
+    def get(self, key):
+        '''Return (found, is_error, value) and count a hit or a miss.'''
+        with self.lock:
+            entry = self._entry(key)
+            if entry is None:
+                self.misses += 1
+                return False, False, None
+            self.hits += 1
+            # move to the most-recently-used end
+            del self.entries[key]
+            self.entries[key] = entry
+            return True, entry[1], entry[2]
+
+    def put(self, key, value, is_error=False):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), is_error, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def call(self, key, func, *args, **kwargs):
+        '''Return func(*args, **kwargs), cached under key. Exceptions of
+        the types in cacheable_errors are cached and re-raised.'''
+        cacheable_errors = kwargs.pop('cacheable_errors', ())
+        found, is_error, value = self.get(key)
+        if found:
+            if is_error:
+                raise value
+            return value
+        try:
+            value = func(*args, **kwargs)
+        except cacheable_errors as e:
+            self.put(key, e, is_error=True)
+            raise
+        self.put(key, value)
+        return value
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_errors(self, error_types):
+        '''Drop the cached exceptions of the given types.'''
+        with self.lock:
+            for key, entry in self.entries.items():
+                if entry[1] and isinstance(entry[2], error_types):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def reset_stats(self):
+        '''Start counting hits and misses again, keeping the entries.'''
+        with self.lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries), 'maxsize': self.maxsize}
@@ -1,3 +1,49 @@
 options = {
-    'unavailable_msg': "Delivery date unavailable, use tracking link for current information"
-    }
\ No newline at end of file
+    'unavailable_msg': "Delivery date unavailable, use tracking link for current information",
+
+    # Send Track requests here instead of to UPS, e.g. to the local
+    # stand-in server in standin.py (None = the real UPS endpoints)
+    'tracking_url': None,
+
+    # 'date-only' asks UPS for the latest activity only and stops reading
+    # the response at the delivery date; 'activity' fetches and parses the
+    # whole scan history
+    'lookup_mode': 'date-only',
+
+    # In-memory cache of tracking_info results: number of tracking numbers
+    # kept, and seconds before an entry is looked up again (None = never)
+    'cache_size': 10000,
+    'cache_ttl': None,
+
+    # Limits for each request to UPS: seconds to connect and to wait for
+    # the response, retries for transient failures with a random backoff
+    # of up to retry_backoff * 2**attempt seconds (at most
+    # retry_backoff_max), and a circuit breaker that stops lookups for
+    # breaker_reset seconds after breaker_failures failed lookups in a row.
+    # A failed lookup is remembered in the cache until the next run, so
+    # one tracking number holds a run up for at most
+    # (retries + 1) * (connect_timeout + read_timeout)
+    # + retries * retry_backoff_max seconds: 76 with these values.
+    'connect_timeout': 5,
+    'read_timeout': 15,
+    'retries': 2,
+    'retry_backoff': 0.5,
+    'retry_backoff_max': 8,
+    'breaker_failures': 5,
+    'breaker_reset': 60,
+
+    # Most HTTP requests each TrackingClient sends per second, retries
+    # included (None = no cap); prefetch_tracking_info can change it
+    'requests_per_second': None,
+
+    # Results kept between runs (sqlite file, None to turn off), and how
+    # many seconds a result is trusted for, by what UPS reported
+    'store_file': 'ups_tracking.sqlite',
+    'store_ttl': {
+        'delivered': 90 * 24 * 3600,
+        'scheduled': 3 * 24 * 3600,
+        'rescheduled': 24 * 3600,
+        'unavailable': 2 * 3600,
+        'invalid': 30 * 24 * 3600,
+        },
+    }
@@ -0,0 +1,131 @@
+'''Timings and sizes of the requests made to UPS.
+
+TrackingClient records one sample per HTTP request (a lookup that is
+retried makes several) and one outcome per lookup. Each request sample
+has the seconds spent connecting (new connections only), waiting for the
+first byte of the response, reading the body and parsing it, the response
+size in bytes, and a code: "HTTP 200", "HTTP 503", "timeout" and so on.
+Lookup outcomes are the status UPS reported ('scheduled', 'delivered',
+...), 'invalid', 'failed' or 'suspended' (circuit breaker open), with the
+lookup's total time including retries. Lookups answered by the on-disk
+store without asking UPS are counted too.
+
+summary() reduces the samples to counts and percentiles; save_json()
+writes that summary to a file.
+'''
+
+import json
+import math
+import threading
+import time
+
+PERCENTILES = (50, 90, 99)
+
+# phases of a request, in the order they happen
+PHASES = ('connect', 'ttfb', 'body', 'parse')
+
+
+def percentile(sorted_values, pct):
+    '''Nearest-rank percentile of an already sorted, non-empty list.'''
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[max(0, min(rank, len(sorted_values)) - 1)]
+
+
+def describe(values):
+    '''count, mean, max and PERCENTILES of a list of numbers.'''
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    summary = {'count': len(values),
+               'mean': sum(values) / float(len(values)),
+               'max': values[-1]}
+    for pct in PERCENTILES:
+        summary['p%d' % pct] = percentile(values, pct)
+    return summary
+
+
+class LookupMetrics(object):
+    '''Collects request samples and lookup outcomes; safe to share
+    between threads.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.phases = dict((phase, []) for phase in PHASES)
+            self.request_times = []
+            self.response_bytes = []
+            self.codes = {}
+            self.lookup_times = []
+            self.outcomes = {}
+            self.store_hits = 0
+
+    def record_request(self, sample):
+        '''Add one request's sample: a dict with any of PHASES (seconds),
+        'bytes' and 'code'.'''
+        with self.lock:
+            for phase in PHASES:
+                if phase in sample:
+                    self.phases[phase].append(sample[phase])
+            self.request_times.append(sum(sample.get(phase, 0)
+                                          for phase in PHASES))
+            if 'bytes' in sample:
+                self.response_bytes.append(sample['bytes'])
+            code = sample.get('code', 'unknown')
+            self.codes[code] = self.codes.get(code, 0) + 1
+
+    def record_lookup(self, outcome, seconds):
+        with self.lock:
+            self.lookup_times.append(seconds)
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def record_store_hit(self):
+        with self.lock:
+            self.store_hits += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                'since': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                       time.localtime(self.started_at)),
+                'seconds': dict([(phase, describe(values)) for phase, values
+                                 in self.phases.items()] +
+                                [('request', describe(self.request_times)),
+                                 ('lookup', describe(self.lookup_times))]),
+                'response_bytes': describe(self.response_bytes),
+                'requests': len(self.request_times),
+                'store_hits': self.store_hits,
+                'codes': dict(self.codes),
+                'outcomes': dict(self.outcomes),
+                }
+
+    def report_lines(self):
+        '''The summary as a few lines of text, times in milliseconds.'''
+        summary = self.summary()
+        if not summary['outcomes'] and not summary['codes']:
+            return []
+
+        def line(label, stats, scale, unit):
+            if not stats['count']:
+                return '%-9s -' % label
+            return '%-9s n=%-6d %s  max %.1f%s' % (
+                label, stats['count'],
+                '  '.join('p%d %.1f%s' % (pct, stats['p%d' % pct] * scale, unit)
+                          for pct in PERCENTILES),
+                stats['max'] * scale, unit)
+
+        lines = [line(name, summary['seconds'][name], 1000, 'ms')
+                 for name in PHASES + ('request', 'lookup')]
+        lines.append(line('bytes', summary['response_bytes'], 1, ''))
+        lines.append('codes     %s' % ', '.join(
+            '%s=%d' % item for item in sorted(summary['codes'].items())))
+        lines.append('outcomes  %s' % ', '.join(
+            '%s=%d' % item for item in sorted(summary['outcomes'].items())))
+        return lines
+
+    def save_json(self, path):
+        with open(path, 'w') as out_file:
+            json.dump(self.summary(), out_file, indent=2, sort_keys=True)
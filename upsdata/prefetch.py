@@ -0,0 +1,48 @@
+'''Look up many tracking numbers at once, ahead of when they're needed.
+
+prefetch_tracking_info runs tracking_info for a batch of tracking numbers
+on a pool of threads, so the results are waiting in tracking_cache when
+each notification asks for its date. The TrackingClient's RateLimiter
+keeps the requests actually sent to UPS under a requests-per-second cap;
+answers from the cache or the on-disk store aren't held back.
+'''
+
+from multiprocessing.pool import ThreadPool
+
+from upsdata import tracking_info, tracking_cache, get_client
+
+
+def prefetch_tracking_info(userid, password, access_license, tracking_numbers,
+                           concurrency=8, requests_per_second=None,
+                           testing=False):
+    '''Look up each distinct tracking number with up to `concurrency`
+    requests in flight. Numbers already in tracking_cache are skipped.
+
+    requests_per_second, if given, becomes the cap on HTTP requests of the
+    shared TrackingClient for these credentials (see TrackingClient.post),
+    so it also applies to later lookups.
+
+    Returns {tracking_number: date text or the exception raised}; the same
+    outcomes are left in tracking_cache for later tracking_info calls.'''
+    pending = sorted(set(number for number in tracking_numbers
+                         if (number, testing) not in tracking_cache))
+    if not pending:
+        return {}
+    if requests_per_second is not None:
+        get_client(userid, password, access_license,
+                   testing).limiter.set_rate(requests_per_second)
+
+    def lookup(tracking_number):
+        try:
+            return tracking_number, tracking_info(userid, password,
+                                                  access_license,
+                                                  tracking_number, testing)
+        except Exception as e:
+            return tracking_number, e
+
+    pool = ThreadPool(max(1, min(concurrency, len(pending))))
+    try:
+        return dict(pool.map(lookup, pending))
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,28 @@
+'''Pacing for calls made from several threads at once.'''
+
+import threading
+import time
+
+
+class RateLimiter(object):
+    '''Spaces out calls to wait() so they average no more than `rate` per
+    second, across all threads. A rate of None means no limit.'''
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.interval = 1.0 / rate if rate else 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,197 @@
+'''Local stand-in for the UPS Track XML endpoint, for testing without UPS.
+
+Answers Track requests with the canned responses in fixtures/ (scheduled,
+rescheduled, unavailable, delivered and error by default; any other
+fixture, such as delivered_unavailable, can be given a weight). Each
+tracking number always gets the same kind of response, picked from its
+hash using the weights in `mix`. Latency and failures can be added: every response can
+be delayed, a share of requests can get HTTP 503, and a share can be held
+open for `hang` seconds to exercise client timeouts.
+
+Point the client at it with options['tracking_url'] (or main.py's
+--ups-url option), e.g. http://127.0.0.1:8765/ups.app/xml/Track
+
+run as: "python standin.py [--port 8765] [--latency 0.2] [--jitter 0.1]
+                           [--error-rate 0.05] [--hang-rate 0.01]
+                           [--mix scheduled=70,unavailable=10,...]"
+'''
+
+import glob
+import hashlib
+import os
+import random
+import re
+import string
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import date, timedelta
+from SocketServer import ThreadingMixIn
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+fixtures_dir = os.path.join(__location__, 'fixtures')
+
+default_mix = [('scheduled', 70), ('rescheduled', 10), ('unavailable', 10),
+               ('delivered', 5), ('error', 5)]
+
+
+def load_fixtures():
+    '''Every fixtures/*.xml, by name.'''
+    fixtures = {}
+    for path in glob.glob(os.path.join(fixtures_dir, '*.xml')):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as fixture:
+            fixtures[name] = string.Template(fixture.read())
+    return fixtures
+
+
+class StandinSettings(object):
+
+    def __init__(self, mix=None, latency=0.0, jitter=0.0, error_rate=0.0,
+                 hang_rate=0.0, hang=60.0):
+        self.mix = mix or default_mix
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+
+    def outcome(self, tracking_number):
+        '''The fixture a tracking number always gets.'''
+        total = sum(weight for name, weight in self.mix)
+        point = int(hashlib.md5(tracking_number).hexdigest(), 16) % total
+        for name, weight in self.mix:
+            if point < weight:
+                return name
+            point -= weight
+        return self.mix[-1][0]
+
+
+class TrackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, like the UPS servers
+
+    def do_POST(self):
+        server = self.server
+        settings = server.settings
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server.count('requests')
+
+        delay = settings.latency + random.uniform(0, settings.jitter)
+        if settings.hang_rate and random.random() < settings.hang_rate:
+            server.count('hung')
+            delay = settings.hang
+        if delay:
+            time.sleep(delay)
+
+        if settings.error_rate and random.random() < settings.error_rate:
+            server.count('http_errors')
+            return self.reply(503, 'Service temporarily unavailable')
+
+        match = re.search(r'<TrackingNumber>\s*([^<\s]*)\s*</TrackingNumber>', body)
+        tracking_number = match.group(1) if match else ''
+        outcome = settings.outcome(tracking_number)
+        server.count(outcome)
+        self.reply(200, self.render(outcome, tracking_number),
+                   content_type='application/xml')
+
+    def render(self, outcome, tracking_number):
+        today = date.today()
+        day = lambda days: (today + timedelta(days=days)).strftime('%Y%m%d')
+        return self.server.fixtures[outcome].safe_substitute(
+            tracking_number=tracking_number,
+            shipper_number=tracking_number[2:8],
+            pickup_date=day(-1),
+            delivery_date=day(2),
+            rescheduled_date=day(4))
+
+    def reply(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings=None, verbose=False):
+        HTTPServer.__init__(self, address, TrackHandler)
+        self.settings = settings or StandinSettings()
+        self.fixtures = load_fixtures()
+        self.verbose = verbose
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/ups.app/xml/Track' % (host, port)
+
+
+def start_in_thread(settings=None, host='127.0.0.1', port=0):
+    '''Start a stand-in server on a background thread and return it;
+    call shutdown() on it when done. Port 0 picks a free port.'''
+    server = StandinServer((host, port), settings)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def parse_mix(text):
+    mix = []
+    names = load_fixtures()
+    for part in text.split(','):
+        name, weight = part.split('=')
+        if name not in names:
+            raise ValueError('unknown response type: %s' % name)
+        mix.append((name, int(weight)))
+    return mix
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Local stand-in for the UPS '
+                                     'Track XML endpoint.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="up to this many more seconds, at random")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="share of requests answered with HTTP 503")
+    parser.add_argument('--hang-rate', type=float, default=0.0,
+                        help="share of requests held open for --hang seconds")
+    parser.add_argument('--hang', type=float, default=60.0)
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help="response weights, e.g. scheduled=70,error=5")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    settings = StandinSettings(mix=args.mix, latency=args.latency,
+                               jitter=args.jitter, error_rate=args.error_rate,
+                               hang_rate=args.hang_rate, hang=args.hang)
+    server = StandinServer((args.host, args.port), settings,
+                           verbose=args.verbose)
+    print "Serving UPS Track stand-in at %s" % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print "Responses sent: %s" % ', '.join(
+            '%s=%d' % item for item in sorted(server.counts.items()))
+
+
+if __name__ == '__main__':
+    main()
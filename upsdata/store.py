@@ -0,0 +1,149 @@
+'''On-disk store of UPS tracking results, shared between runs.
+
+Each result is kept with the status UPS reported, and expires after the
+time options['store_ttl'] gives for that status: a delivered package can
+be remembered for weeks, a missing delivery date only for a short while.
+Tracking numbers UPS rejected are stored with the status 'invalid'.
+
+run as: "python store.py list [--status STATUS] [--expired]"
+    or: "python store.py purge (--all | --expired | --status STATUS |
+                                TRACKING_NUMBER ...)"
+'''
+
+import sqlite3
+import threading
+import time
+
+from config import options
+
+STATUSES = ('delivered', 'scheduled', 'rescheduled', 'unavailable', 'invalid')
+
+
+class TrackingStore(object):
+
+    def __init__(self, path, ttls=None):
+        self.path = path
+        self.ttls = ttls if ttls is not None else options['store_ttl']
+        # lookups may come from several threads; sqlite needs one at a time
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS tracking_results ('
+                              ' tracking_number TEXT PRIMARY KEY,'
+                              ' status TEXT,'
+                              ' result TEXT,'
+                              ' fetched_at REAL,'
+                              ' expires_at REAL)')
+            self.conn.commit()
+
+    def get(self, tracking_number):
+        '''Return (status, result) for an unexpired entry, else None.'''
+        with self.lock:
+            row = self.conn.execute('SELECT status, result FROM tracking_results'
+                                    ' WHERE tracking_number = ? AND expires_at > ?',
+                                    (tracking_number, time.time())).fetchone()
+        if row is None:
+            return None
+        return str(row[0]), row[1]
+
+    def put(self, tracking_number, status, result):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO tracking_results'
+                              ' VALUES (?, ?, ?, ?, ?)',
+                              (tracking_number, status, result, now,
+                               now + self.ttls[status]))
+            self.conn.commit()
+
+    def entries(self, status=None, expired_only=False):
+        '''(tracking_number, status, result, fetched_at, expires_at) rows,
+        most recently fetched first.'''
+        query = 'SELECT * FROM tracking_results WHERE 1'
+        args = []
+        if status:
+            query += ' AND status = ?'
+            args.append(status)
+        if expired_only:
+            query += ' AND expires_at <= ?'
+            args.append(time.time())
+        with self.lock:
+            return self.conn.execute(query + ' ORDER BY fetched_at DESC',
+                                     args).fetchall()
+
+    def purge(self, tracking_numbers=(), status=None, expired_only=False,
+              everything=False):
+        '''Delete entries; returns the number deleted.'''
+        with self.lock:
+            if everything:
+                cursor = self.conn.execute('DELETE FROM tracking_results')
+            elif tracking_numbers:
+                cursor = self.conn.executemany(
+                    'DELETE FROM tracking_results WHERE tracking_number = ?',
+                    [(number,) for number in tracking_numbers])
+            elif status:
+                cursor = self.conn.execute(
+                    'DELETE FROM tracking_results WHERE status = ?', (status,))
+            elif expired_only:
+                cursor = self.conn.execute(
+                    'DELETE FROM tracking_results WHERE expires_at <= ?',
+                    (time.time(),))
+            else:
+                return 0
+            self.conn.commit()
+            return cursor.rowcount
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    import argparse
+
+    def timestamp(seconds):
+        return time.strftime("%Y/%m/%d %H:%M", time.localtime(seconds))
+
+    parser = argparse.ArgumentParser(description='Inspect or purge stored '
+                                     'UPS tracking results.')
+    parser.add_argument('--db', default=options['store_file'],
+                        help="store file (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command')
+
+    list_parser = commands.add_parser('list', help="show stored results")
+    list_parser.add_argument('--status', choices=STATUSES)
+    list_parser.add_argument('--expired', action='store_true',
+                             help="only show expired entries")
+
+    purge_parser = commands.add_parser('purge', help="delete stored results")
+    purge_parser.add_argument('tracking_numbers', nargs='*')
+    purge_parser.add_argument('--status', choices=STATUSES)
+    purge_parser.add_argument('--expired', action='store_true')
+    purge_parser.add_argument('--all', dest='everything', action='store_true')
+
+    args = parser.parse_args()
+    store = TrackingStore(args.db)
+    try:
+        if args.command == 'list':
+            now = time.time()
+            rows = store.entries(status=args.status, expired_only=args.expired)
+            for number, status, result, fetched_at, expires_at in rows:
+                print "%-20s %-12s fetched %s  %s %s  %s" % (
+                    number, status, timestamp(fetched_at),
+                    'expired' if expires_at <= now else 'expires',
+                    timestamp(expires_at), result)
+            print "%d entries" % len(rows)
+        else:
+            if not (args.tracking_numbers or args.status or args.expired
+                    or args.everything):
+                parser.error("purge needs tracking numbers, --status, "
+                             "--expired or --all")
+            deleted = store.purge(tracking_numbers=args.tracking_numbers,
+                                  status=args.status,
+                                  expired_only=args.expired,
+                                  everything=args.everything)
+            print "%d entries deleted" % deleted
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,81 +12,603 @@ def TestDirs():
     print "os.path.join(__location__, 'bundled-resource.jpg')", os.path.join(__location__, 'bundled-resource.jpg')
     print "os.path.dirname(__file__)", os.path.dirname(__file__)
     
+import httplib
+import os
+import random
+import socket
+import threading
+import time
+import urlparse
+from datetime import datetime
+from xml.parsers.expat import ExpatError
+# datetime.strptime imports this lazily, which fails when threads race to
+# do it first (Python issue 7980)
+import _strptime
+
+# External open-source XML processing library.
+import xmltodict_static as xmltodict
+# If xmltodict library were installed on the system, could use that instead of 
+# the downloaded xmltodict_static.py file:
+# import xmltodict
+
+from config import options
+from cache import LookupCache
+from metrics import LookupMetrics
+from ratelimit import RateLimiter
+from store import TrackingStore
+
 class TrackingNumberInvalid(Exception):
     pass
 
-def tracking_info(userid, password, access_license, tracking_number, testing=False):
-    from config import options
-    import os
-    import urllib2
-    from datetime import datetime
-
-    # External open-source XML processing library.
-    import xmltodict_static as xmltodict
-    # If xmltodict library were installed on the system, could use that instead of 
-    # the downloaded xmltodict_static.py file:
-    # import xmltodict
-    
-    no_date_message = options['unavailable_msg']
-    ups_testing_url = "https://wwwcie.ups.com/ups.app/xml/Track"
-    ups_tracking_url = "https://www.ups.com/ups.app/xml/Track"
+# Results of tracking_info for this process, keyed by tracking number.
+# A number UPS rejected is cached too, so it isn't sent again, and so is a
+# lookup that failed, until forget_failed_lookups.
+tracking_cache = LookupCache(maxsize=options['cache_size'],
+                             ttl=options['cache_ttl'])
 
-    #ups_testing_tracknum = '1Z12345E6692804405' # --> a date in 2010
-    
-    if testing:
-        target_url = ups_testing_url
+# Timings of the requests sent to UPS by every TrackingClient (see metrics.py)
+lookup_metrics = LookupMetrics()
+
+# Results kept between runs (see store.py); opened by get_tracking_store
+tracking_store = None
+
+def get_tracking_store():
+    '''The TrackingStore at options['store_file'], opened on first use,
+    or None if the store is turned off.'''
+    global tracking_store
+    if tracking_store is None and options['store_file']:
+        tracking_store = TrackingStore(options['store_file'])
+    return tracking_store
+
+def tracking_info(userid, password, access_license, tracking_number, testing=False,
+                  use_cache=True):
+    '''Expected delivery date for a package, as "mm/dd/yyyy", or
+    options['unavailable_msg'] if UPS doesn't give one. Raises
+    TrackingNumberInvalid if UPS rejects the number.
+
+    Each tracking number is looked up at most once while it stays in
+    tracking_cache, and not at all while the on-disk store holds an
+    unexpired result for it. A TrackingServiceError is cached as well, so
+    a failed number isn't retried until forget_failed_lookups is called.
+    Pass use_cache=False to always ask UPS.'''
+    if not use_cache:
+        return fetch_tracking_info(userid, password, access_license,
+                                   tracking_number, testing)
+    return tracking_cache.call((tracking_number, testing), stored_tracking_info,
+                               userid, password, access_license,
+                               tracking_number, testing,
+                               cacheable_errors=(TrackingNumberInvalid,
+                                                 TrackingServiceError))
+
+def stored_tracking_info(userid, password, access_license, tracking_number, testing=False):
+    '''tracking_info answered from the on-disk store when possible. Results
+    from the UPS testing server, or from another tracking_url, are never
+    stored.'''
+    if testing or options['tracking_url']:
+        store = None
     else:
-        target_url = ups_tracking_url
+        store = get_tracking_store()
+    if store is not None:
+        entry = store.get(tracking_number)
+        if entry is not None:
+            lookup_metrics.record_store_hit()
+            status, result = entry
+            if status == 'invalid':
+                raise TrackingNumberInvalid(result)
+            return format_delivery_date(result)
 
+    try:
+        status, scheduled_date = fetch_tracking_status(userid, password, access_license,
+                                                       tracking_number, testing)
+    except TrackingNumberInvalid as e:
+        if store is not None:
+            store.put(tracking_number, 'invalid', unicode(e.args[0] if e.args else ''))
+        raise
+    if store is not None:
+        store.put(tracking_number, status, scheduled_date or '')
+    return format_delivery_date(scheduled_date)
 
-    # Resource files are in script directory
-    __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-    xml_template_file = os.path.join(__location__, 'ups_request_template.xml')
-    
-    #The UPS tracking API requires requests to be structured as XML, so the
-    #user information and tracking number are inserted into this XML file template.
-    xml_template = open(xml_template_file).read()
-    xml_request = xml_template.format(USERID = userid, PASS = password,
-                                      ACCESS_LICENSE = access_license,
-                                      TRACKING_NUMBER = tracking_number)
-                                      
-    request = urllib2.Request(target_url, xml_request)
-    response = urllib2.urlopen(request)
-    xml_result = response.read()
-    
+def forget_failed_lookups():
+    '''Let tracking numbers whose lookups failed be asked about again
+    (main.run_job calls this at the start of each run).'''
+    tracking_cache.discard_errors(TrackingServiceError)
+
+def forget_tracking_info(tracking_number, testing=False):
+    '''Drop any cached or stored result for a tracking number, so the next
+    tracking_info call asks UPS again.'''
+    tracking_cache.discard((tracking_number, testing))
+    store = None if testing else get_tracking_store()
+    if store is not None:
+        store.purge(tracking_numbers=[tracking_number])
+
+def format_delivery_date(scheduled_date):
+    # convert "20141224" format to "12/24/2014" format
+    if scheduled_date:
+        return datetime.strptime(scheduled_date, '%Y%m%d').strftime('%m/%d/%Y')
+    else:
+        return options['unavailable_msg']
+
+def fetch_tracking_info(userid, password, access_license, tracking_number, testing=False):
+    status, scheduled_date = fetch_tracking_status(userid, password, access_license,
+                                                   tracking_number, testing)
+    return format_delivery_date(scheduled_date)
+
+def fetch_tracking_status(userid, password, access_license, tracking_number, testing=False):
+    '''Ask UPS about one package, through the shared TrackingClient for
+    these credentials. See TrackingClient.fetch_status.'''
+    client = get_client(userid, password, access_license, testing)
+    return client.fetch_status(tracking_number)
+
+
+class TrackingServiceError(Exception):
+    '''UPS could not be reached, or answered with an HTTP error. `code`
+    says which, for lookup_metrics: "HTTP 503", "timeout" and so on.'''
+    def __init__(self, msg, transient=True, code=None):
+        Exception.__init__(self, msg)
+        self.transient = transient
+        self.code = code
+
+
+class TrackingServiceUnavailable(TrackingServiceError):
+    '''Lookups are being refused without contacting UPS because recent
+    ones kept failing (see CircuitBreaker).'''
+    def __init__(self, msg):
+        TrackingServiceError.__init__(self, msg, transient=False)
+
+
+class CircuitBreaker(object):
+    '''Stops calls to a failing service for a while.
+
+    After `failure_threshold` failures in a row the breaker opens and
+    before_call() raises TrackingServiceUnavailable at once. When
+    `reset_timeout` seconds have passed, a single trial call is let
+    through; if it succeeds the breaker closes again, otherwise it stays
+    open for another reset_timeout.'''
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            waited = time.time() - self.opened_at
+            if waited < self.reset_timeout or self.trial_running:
+                raise TrackingServiceUnavailable(
+                    'UPS lookups suspended after %d failures in a row'
+                    % self.failures)
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self.trial_running = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class ConnectionPool(object):
+    '''Keep-alive HTTPS connections to one host, reused across requests.
+    Up to `size` idle connections are kept; more can be open at once when
+    several threads send requests together.'''
+
+    def __init__(self, scheme, host, port=None, size=4,
+                 connect_timeout=None, read_timeout=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.new_connection(), False
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class TrackingClient(object):
+    '''Sends Track requests for one set of UPS credentials. The request
+    template is read once and connections to the tracking server are kept
+    open between lookups.
+
+    With lookup_mode 'date-only', UPS is asked for the latest activity only
+    (not the full scan history) and the response is read just far enough
+    to find the delivery date; 'activity' asks for and parses everything.
+
+    Every request has connect and read timeouts. Transient failures are
+    retried up to `retries` times, waiting a random time of up to
+    retry_backoff * 2**attempt seconds (capped at retry_backoff_max) in
+    between. Failures that outlast the retries count towards a
+    CircuitBreaker, which then fails further lookups straight away. One
+    lookup therefore takes at most about
+        (retries + 1) * (connect_timeout + read_timeout)
+        + retries * retry_backoff_max
+    seconds, and once the breaker is open only one lookup per
+    breaker_reset seconds pays that cost.'''
+
+    def __init__(self, userid, password, access_license, testing=False,
+                 url=None, pool_size=4, lookup_mode=None,
+                 connect_timeout=None, read_timeout=None, retries=None,
+                 retry_backoff=None, retry_backoff_max=None,
+                 breaker_failures=None, breaker_reset=None, metrics=None,
+                 requests_per_second=None):
+        def option(value, name):
+            return options[name] if value is None else value
+
+        if url is None:
+            url = options['tracking_url']
+        if url is None:
+            url = ups_testing_url if testing else ups_tracking_url
+        self.url = url
+        parts = urlparse.urlsplit(url)
+        self.path = parts.path or '/'
+        self.pool = ConnectionPool(parts.scheme, parts.hostname, parts.port,
+                                   size=pool_size,
+                                   connect_timeout=option(connect_timeout, 'connect_timeout'),
+                                   read_timeout=option(read_timeout, 'read_timeout'))
+        self.retries = option(retries, 'retries')
+        self.retry_backoff = option(retry_backoff, 'retry_backoff')
+        self.retry_backoff_max = option(retry_backoff_max, 'retry_backoff_max')
+        self.breaker = CircuitBreaker(option(breaker_failures, 'breaker_failures'),
+                                      option(breaker_reset, 'breaker_reset'))
+        self.lookup_mode = option(lookup_mode, 'lookup_mode')
+        self.userid = userid
+        self.password = password
+        self.access_license = access_license
+        self.xml_template = read_request_template()
+        self.metrics = lookup_metrics if metrics is None else metrics
+        self.limiter = RateLimiter(option(requests_per_second,
+                                          'requests_per_second'))
+
+    def request_body(self, tracking_number):
+        #The UPS tracking API requires requests to be structured as XML, so the
+        #user information and tracking number are inserted into this XML file template.
+        return self.xml_template.format(USERID = self.userid, PASS = self.password,
+                                        ACCESS_LICENSE = self.access_license,
+                                        TRACKING_NUMBER = tracking_number,
+                                        REQUEST_OPTION = request_options[self.lookup_mode])
+
+    def post(self, body, sample=None):
+        '''POST body to the tracking URL and return the response body.
+        A reused connection the server has since closed is retried once
+        on a new connection.
+
+        Every request, retries included, first waits its turn with
+        self.limiter. Timings (see metrics.py) go into the `sample` dict if
+        one is given: 'connect' for a new connection, 'ttfb' up to the
+        response headers, 'body' for reading the rest, plus the response
+        'bytes' and 'code'.'''
+        if sample is None:
+            sample = {}
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'Connection': 'keep-alive'}
+        while True:
+            self.limiter.wait()
+            started = time.time()
+            try:
+                conn, reused = self.pool.get()
+            except (httplib.HTTPException, socket.error) as e:
+                sample['connect'] = time.time() - started
+                raise TrackingServiceError('could not connect: %s' % e,
+                                           code='connect error')
+            if not reused:
+                sample['connect'] = time.time() - started
+            try:
+                sent_at = time.time()
+                conn.request('POST', self.path, body, headers)
+                response = conn.getresponse()
+                sample['ttfb'] = time.time() - sent_at
+                read_at = time.time()
+                xml_result = response.read()
+                sample['body'] = time.time() - read_at
+            except socket.timeout as e:
+                conn.close()
+                raise TrackingServiceError('timed out: %s' % e, code='timeout')
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise TrackingServiceError(e, code='connection error')
+            sample['bytes'] = len(xml_result)
+            sample['code'] = 'HTTP %d' % response.status
+            if response.getheader('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                self.pool.put(conn)
+            if response.status != 200:
+                # server trouble and rate limiting may pass; other errors won't
+                transient = response.status >= 500 or response.status == 429
+                raise TrackingServiceError('HTTP %d %s' % (response.status,
+                                                           response.reason),
+                                           transient=transient,
+                                           code=sample['code'])
+            return xml_result
+
+    def fetch_status(self, tracking_number):
+        '''Ask UPS about one package. Returns (status, date): status is one
+        of 'delivered', 'scheduled', 'rescheduled' or 'unavailable', and
+        date is the delivery date as "yyyymmdd", or None if UPS gives none.
+
+        Raises TrackingServiceError if UPS can't be reached, or
+        TrackingServiceUnavailable while the circuit breaker is open.
+
+        Each request and the lookup's outcome are recorded in
+        self.metrics.'''
+        started = time.time()
+        try:
+            result = self.request_status(tracking_number)
+        except TrackingNumberInvalid:
+            self.metrics.record_lookup('invalid', time.time() - started)
+            raise
+        except TrackingServiceUnavailable:
+            self.metrics.record_lookup('suspended', time.time() - started)
+            raise
+        except TrackingServiceError:
+            self.metrics.record_lookup('failed', time.time() - started)
+            raise
+        self.metrics.record_lookup(result[0], time.time() - started)
+        return result
+
+    def request_status(self, tracking_number):
+        '''fetch_status, without recording the lookup's outcome.'''
+        self.breaker.before_call()
+        body = self.request_body(tracking_number)
+        attempt = 0
+        while True:
+            sample = {}
+            try:
+                xml_result = self.post(body, sample)
+                parse_started = time.time()
+                try:
+                    result = self.parse_response(xml_result)
+                finally:
+                    sample['parse'] = time.time() - parse_started
+            except TrackingNumberInvalid:
+                # a proper answer from UPS, just not a happy one
+                self.metrics.record_request(sample)
+                self.breaker.record_success()
+                raise
+            except TrackingServiceError as e:
+                sample['code'] = e.code or sample.get('code')
+                self.metrics.record_request(sample)
+                if not e.transient or attempt >= self.retries:
+                    self.breaker.record_failure()
+                    raise
+                delay = min(self.retry_backoff * 2 ** attempt,
+                            self.retry_backoff_max)
+                time.sleep(random.uniform(0, delay))
+                attempt += 1
+                continue
+            self.metrics.record_request(sample)
+            self.breaker.record_success()
+            return result
+
+    def parse_response(self, xml_result):
+        '''(status, date) from a response body. A body that isn't a
+        readable TrackResponse (truncated, or some other document) raises
+        TrackingServiceError, so it's retried and counts as a failure.'''
+        try:
+            if self.lookup_mode == 'date-only':
+                return scan_track_response(xml_result)
+            return parse_track_response(xml_result)
+        except (ExpatError, KeyError, TypeError) as e:
+            raise TrackingServiceError('bad response from UPS: %r' % e,
+                                       code='bad response')
+
+    def fetch_info(self, tracking_number):
+        return format_delivery_date(self.fetch_status(tracking_number)[1])
+
+    def close(self):
+        self.pool.close()
+
+
+# RequestOption sent for each lookup mode: "activity" returns every scan
+# of the package, "none" only the latest one
+request_options = {
+    'activity': 'activity',
+    'date-only': 'none',
+    }
+
+ups_testing_url = "https://wwwcie.ups.com/ups.app/xml/Track"
+ups_tracking_url = "https://www.ups.com/ups.app/xml/Track"
+
+#ups_testing_tracknum = '1Z12345E6692804405' # --> a date in 2010
+
+# Resource files are in script directory
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+xml_template_file = os.path.join(__location__, 'ups_request_template.xml')
+
+def read_request_template():
+    with open(xml_template_file) as template_file:
+        return template_file.read()
+
+# One client per set of credentials, shared by tracking_info calls
+tracking_clients = {}
+tracking_clients_lock = threading.Lock()
+
+def get_client(userid, password, access_license, testing=False):
+    key = (userid, password, access_license, testing)
+    with tracking_clients_lock:
+        if key not in tracking_clients:
+            tracking_clients[key] = TrackingClient(userid, password, access_license,
+                                                   testing)
+        return tracking_clients[key]
+
+def close_clients():
+    '''Close the connections of every shared TrackingClient.'''
+    with tracking_clients_lock:
+        clients = tracking_clients.values()
+        tracking_clients.clear()
+    for client in clients:
+        client.close()
+
+def parse_track_response(xml_result):
+    '''Read (status, date) out of a TrackResponse document; see
+    TrackingClient.fetch_status.'''
     full_result = xmltodict.parse(xml_result)
 
-    root = full_result['TrackResponse']
+    # anything without a status code (a maintenance page, say) isn't an
+    # answer about this tracking number
+    root = full_result.get('TrackResponse')
+    response_info = root.get('Response') if isinstance(root, dict) else None
+    if (not isinstance(response_info, dict)
+            or 'ResponseStatusCode' not in response_info):
+        raise TrackingServiceError('no TrackResponse status in response',
+                                   code='bad response')
 
     # Confirm status code from server is reported as OK
-    response_info = root['Response']
     status_code = response_info['ResponseStatusCode']
-    if status_code == 0 or 'Error' in response_info:
+    if status_code == '0' or 'Error' in response_info:
         try:
             ups_api_error_info = response_info['Error']['ErrorDescription']
-            raise TrackingNumberInvalid(ups_api_error_info)
-        except:
+        except (KeyError, TypeError):
             raise TrackingNumberInvalid(response_info)
+        raise TrackingNumberInvalid(ups_api_error_info)
         
     # the UPS API labels the date info differently depending on 
     # whether the scheduled date is unavailable, on schedule, or rescheduled,
     # so we need to check which of these fields has been included.
-    shipment = root['Shipment']
-    if "DeliveryDateUnavailable" in shipment:
-        scheduled_date = None
+    shipment = root.get('Shipment')
+    if not isinstance(shipment, dict):
+        raise TrackingServiceError('no Shipment in response',
+                                   code='bad response')
     if 'Package' in shipment and 'RescheduledDeliveryDate' in shipment['Package']:
-    	package = shipment['Package']
-        scheduled_date = package['RescheduledDeliveryDate']
+        package = shipment['Package']
+        status, scheduled_date = 'rescheduled', package['RescheduledDeliveryDate']
     elif 'ScheduledDeliveryDate' in shipment:
-        scheduled_date = shipment['ScheduledDeliveryDate']
+        status, scheduled_date = 'scheduled', shipment['ScheduledDeliveryDate']
     else:
-        scheduled_date = None
-    
-    # convert "20141224" format to "12/24/2014" format
-    if scheduled_date:
-        return datetime.strptime(scheduled_date, '%Y%m%d').strftime('%m/%d/%Y')
+        status, scheduled_date = 'unavailable', None
+
+    if is_delivered(shipment):
+        status = 'delivered'
+    return status, scheduled_date
+
+def scan_track_response(xml_result):
+    '''Read (status, date) from a TrackResponse like parse_track_response,
+    but stop parsing once the answer is known instead of building the
+    whole document. Only the children of Response and Shipment are built,
+    one at a time.'''
+    found = {}
+
+    def handle(path, item):
+        if path[0][0] != 'TrackResponse':
+            return False
+        parent, name = path[1][0], path[2][0]
+        if isinstance(item, basestring):
+            # text at item_depth isn't whitespace-stripped by the parser
+            item = item.strip()
+        if parent == 'Response':
+            if name == 'ResponseStatusCode':
+                found['status_code'] = item
+            elif name == 'Error':
+                found['error'] = item
+                return False
+        elif parent == 'Shipment':
+            found['shipment'] = True
+            if name == 'DeliveryDateUnavailable':
+                # Package (rescheduled date, delivery scan) is still to come
+                found['unavailable'] = True
+            elif name == 'ScheduledDeliveryDate':
+                found['scheduled'] = item
+            elif name == 'Package':
+                # a rescheduled date (and the latest activity) is in Package
+                if isinstance(item, list):
+                    item = item[0]
+                if item and 'RescheduledDeliveryDate' in item:
+                    found['rescheduled'] = item['RescheduledDeliveryDate']
+                found['delivered'] = is_delivered({'Package': item})
+                if ('rescheduled' in found or 'scheduled' in found
+                        or 'unavailable' in found):
+                    return False
+        return True
+
+    try:
+        xmltodict.parse(xml_result, item_depth=3, item_callback=handle)
+    except xmltodict.ParsingInterrupted:
+        pass
+
+    if found.get('status_code') == '0' or 'error' in found:
+        try:
+            ups_api_error_info = found['error']['ErrorDescription']
+        except (KeyError, TypeError):
+            raise TrackingNumberInvalid(found)
+        raise TrackingNumberInvalid(ups_api_error_info)
+    if 'status_code' not in found:
+        raise TrackingServiceError('no TrackResponse status in response',
+                                   code='bad response')
+    if 'shipment' not in found:
+        raise TrackingServiceError('no Shipment in response',
+                                   code='bad response')
+
+    if 'rescheduled' in found:
+        status, scheduled_date = 'rescheduled', found['rescheduled']
+    elif 'scheduled' in found:
+        status, scheduled_date = 'scheduled', found['scheduled']
     else:
-        return no_date_message
+        status, scheduled_date = 'unavailable', None
+    if found.get('delivered'):
+        status = 'delivered'
+    return status, scheduled_date
+
+def is_delivered(shipment):
+    '''True if the latest package activity is a delivery scan (status
+    type "D").'''
+    package = shipment.get('Package')
+    if isinstance(package, list):
+        package = package[0]
+    if not package or 'Activity' not in package:
+        return False
+    activity = package['Activity']
+    if isinstance(activity, list):
+        activity = activity[0]   # newest first
+    try:
+        return activity['Status']['StatusType']['Code'] == 'D'
+    except (KeyError, TypeError):
+        return False
     
 
 def Test(access_license, userid, password, tracking_number):
@@ -95,11 +617,11 @@ def Test(access_license, userid, password, tracking_number):
     #access_license = raw_input("access license number: ")
     
 
-    print TrackingInfo(userid = userid,
-                       password = password,
-                       access_license = access_license,
-                       tracking_number = tracking_number,
-                       testing=True)
+    print tracking_info(userid = userid,
+                        password = password,
+                        access_license = access_license,
+                        tracking_number = tracking_number,
+                        testing=True)
     
 if __name__=='__main__':
     import sys
@@ -115,8 +637,9 @@ if __name__=='__main__':
     
 
     #run as: "python upsdata.py [userid] [password] [license] [tracknum]"
+    # (set options['tracking_url'] to try it against standin.py instead)
 
     Test(access_license=sys.argv[1], 
          userid=sys.argv[2],
          password=sys.argv[3],
-         tracking_number=sys.argv[4])
\ No newline at end of file
+         tracking_number=tracknum)
\ No newline at end of file
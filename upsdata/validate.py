@@ -0,0 +1,69 @@
+'''Check tracking numbers locally before asking UPS about them.
+
+A UPS "1Z" number is 18 characters: "1Z", a 6 character shipper number,
+a 2 digit service code, a 7 digit package reference and a check digit.
+The check digit is computed from characters 3-17, with letters counted as
+digits (A=2, B=3, ... I=0, ...) and every second character doubled.
+'''
+
+import re
+
+from upsdata import TrackingNumberInvalid
+
+ups_pattern = re.compile(r'^1Z[0-9A-Z]{16}$')
+
+# Formats of other carriers' numbers that turn up in the shipping export,
+# most specific first (USPS and FedEx both use all-digit 20/22 digit forms)
+other_carrier_patterns = [
+    ('USPS', re.compile(r'^(9[1-5]\d{18,20}|[A-Z]{2}\d{9}US)$')),
+    ('FedEx', re.compile(r'^(\d{12}|\d{15}|\d{20}|\d{22})$')),
+    ]
+
+
+def normalize_tracking_number(value):
+    '''Uppercase, and drop the spaces and dashes people type into numbers.'''
+    return re.sub(r'[\s-]', '', str(value)).upper()
+
+
+def ups_check_digit(tracking_number):
+    '''The check digit a 1Z number should end with.'''
+    total = 0
+    for i, char in enumerate(tracking_number[2:17]):
+        if char.isdigit():
+            value = int(char)
+        else:
+            value = (ord(char) - 63) % 10
+        if i % 2:
+            value *= 2
+        total += value
+    return (10 - total % 10) % 10
+
+
+def identify_carrier(tracking_number):
+    '''"UPS", another carrier's name, or None if the format isn't known.
+    Expects a normalized number.'''
+    if ups_pattern.match(tracking_number):
+        return 'UPS'
+    for carrier, pattern in other_carrier_patterns:
+        if pattern.match(tracking_number):
+            return carrier
+    return None
+
+
+def validate_ups_tracking_number(tracking_number, verify_check_digit=True):
+    '''Raise TrackingNumberInvalid unless tracking_number (normalized) is a
+    well-formed UPS 1Z number with a correct check digit.'''
+    if not tracking_number:
+        raise TrackingNumberInvalid('no tracking number')
+    carrier = identify_carrier(tracking_number)
+    if carrier is None:
+        raise TrackingNumberInvalid('not a recognised tracking number format: %s'
+                                    % tracking_number)
+    if carrier != 'UPS':
+        raise TrackingNumberInvalid('%s tracking number, not UPS: %s'
+                                    % (carrier, tracking_number))
+    if verify_check_digit:
+        check = tracking_number[17]
+        if not check.isdigit() or int(check) != ups_check_digit(tracking_number):
+            raise TrackingNumberInvalid('check digit does not match: %s'
+                                        % tracking_number)